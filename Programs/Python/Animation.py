@@ -1,11 +1,12 @@
 import numpy as np
 import colorsys
+import traceback
 
-from PyQt5.QtCore import Qt, QObject, pyqtSignal, QTimer, QElapsedTimer, QPointF, QRectF
-from PyQt5.QtGui import QKeySequence, QPalette, QColor, QPainter, QPen, QBrush, QPolygonF, QFont, QPainterPath
-from PyQt5.QtWidgets import QApplication, QWidget, QShortcut, QGridLayout, QPushButton, QGraphicsScene, QGraphicsView, QAbstractGraphicsShapeItem, QGraphicsItem, QGraphicsItemGroup, QGraphicsTextItem, QGraphicsLineItem, QGraphicsEllipseItem, QGraphicsPolygonItem, QGraphicsRectItem, QGraphicsPathItem
+from PyQt5.QtCore import Qt, QObject, pyqtSignal, QTimer, QElapsedTimer, QPointF, QRectF, QByteArray, QDataStream, QIODevice
+from PyQt5.QtGui import QKeySequence, QPalette, QColor, QPainter, QPen, QBrush, QPolygonF, QFont, QPainterPath, QImage
+from PyQt5.QtWidgets import QApplication, QWidget, QShortcut, QGridLayout, QPushButton, QGraphicsScene, QGraphicsView, QAbstractGraphicsShapeItem, QGraphicsItem, QGraphicsItemGroup, QGraphicsTextItem, QGraphicsLineItem, QGraphicsEllipseItem, QGraphicsPolygonItem, QGraphicsRectItem, QGraphicsPathItem, QStyleOptionGraphicsItem
 
-from Engine import Engine
+from Engine import Engine, worker
 
 # === ITEMS ================================================================
 
@@ -48,7 +49,7 @@ class item():
     Convert the :math:`x` position in scene coordinates
 
     arg:
-      x (float): The :math:`x` position.
+      x (float or array): The :math:`x` position(s).
 
     returns:
       The :math:`x` position in scene coordinates.
@@ -63,7 +64,7 @@ class item():
     Convert the :math:`y` position in scene coordinates
 
     arg:
-      y (float): The :math:`y` position.
+      y (float or array): The :math:`y` position(s).
 
     returns:
       The :math:`y` position in scene coordinates.
@@ -79,12 +80,17 @@ class item():
     Convert the :math:`x` and :math:`y` positions in scene coordinates
 
     arg:
-      xy ([float,float]): The :math:`x` and :math:`y` positions.
+      xy ([float,float] or array): The :math:`x` and :math:`y` positions,
+        or an (n,2) array of positions.
 
     returns:
-      The :math:`x` and :math:`y` position in scene coordinates.
+      The :math:`x` and :math:`y` position in scene coordinates, or an (n,2)
+      array of positions in scene coordinates.
     """
 
+    if isinstance(xy, np.ndarray) and xy.ndim==2:
+      return np.column_stack((self.x2scene(xy[:,0]), self.y2scene(xy[:,1])))
+
     return self.x2scene(xy[0]), self.y2scene(xy[1])
 
   def d2scene(self, d):
@@ -105,13 +111,36 @@ class item():
     Convert an angle in scene coordinates (radian to degrees)
 
     arg:
-      a (float): Angle to convert.
+      a (float or array): Angle(s) to convert.
 
     returns:
       The angle in degrees.
     """
 
     return -a*180/np.pi
+
+  def poly2scene(self, X, Y, A, P):
+    """
+    Vertices of many copies of a polygon in scene coordinates
+
+    The same polygon template is translated to each position and rotated by
+    each angle, for all copies at once.
+
+    arg:
+      X, Y (array): The :math:`x` and :math:`y` positions of the copies.
+      A (array): The orientations of the copies (rad).
+      P (array): The (k,2) vertices of the template, in the copies' frame.
+
+    returns:
+      The horizontal and vertical scene coordinates of the vertices, as two
+      (n,k) arrays.
+    """
+
+    C = np.cos(A)[:,None]
+    S = np.sin(A)[:,None]
+
+    return (self.x2scene(X[:,None] + C*P[:,0] - S*P[:,1]),
+      self.y2scene(Y[:,None] + S*P[:,0] + C*P[:,1]))
   
   def scene2x(self, u):
     """
@@ -410,6 +439,9 @@ class item():
       self.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
     
 class polygon(item, QGraphicsPolygonItem):
+
+  # Polygons in scene coordinates, shared by all items with the same points
+  templates = {}
   
   def __init__(self, animation, name, **kwargs):
    
@@ -444,10 +476,13 @@ class polygon(item, QGraphicsPolygonItem):
 
     self._points = points
 
-    poly = []
-    for p in self._points:
-      poly.append(QPointF(self.x2scene(p[0]), self.y2scene(p[1])))
-    self.setPolygon(QPolygonF(poly))
+    key = (self._parent is None, self.animation.factor, self.animation.boundaries['x'][0],
+      self.animation.boundaries['y'][0], tuple(map(tuple, np.asarray(points, dtype=float))))
+    if key not in polygon.templates:
+      P = self.xy2scene(np.asarray(points, dtype=float))
+      polygon.templates[key] = QPolygonF([QPointF(*p) for p in P])
+
+    self.setPolygon(polygon.templates[key])
   
   # --- Color --------------------------------------------------------------
 
@@ -479,6 +514,258 @@ class polygon(item, QGraphicsPolygonItem):
     self._linestyle = s
     self.setStyle()      
 
+class swarm(item, QGraphicsItem):
+  """
+  Whole swarm in a single item
+
+  All agents are drawn in one paint() call, with a level of detail that
+  depends on the number of agents and on the zoom:
+  - 'polygons': copies of the same polygon, with one painter path per color
+    built from the vertex arrays in a single pass,
+  - 'points': one point per agent, drawn in one call per color,
+  - 'density': a density map (2D histogram of the positions) blitted as a
+    single image.
+  With lod='auto', points are used above lodPoints agents or when the
+  polygons are smaller than lodSize pixels on screen, and the density map
+  above lodDensity agents.
+  """
+
+  def __init__(self, animation, name, **kwargs):
+
+    # Generic item constructor
+    super().__init__(animation, name, **kwargs)
+
+    # --- Definitions
+
+    # Polygon template (in agent frame)
+    if 'points' not in kwargs:
+      raise AttributeError("'points' must be specified for swarm items.")
+    self._points = np.array(kwargs['points'], dtype=float)
+
+    self._thickness = kwargs['thickness'] if 'thickness' in kwargs else 0
+
+    # Level of detail
+    self.lod = kwargs['lod'] if 'lod' in kwargs else 'auto'
+    self.lodPoints = kwargs['lodPoints'] if 'lodPoints' in kwargs else 5000
+    self.lodDensity = kwargs['lodDensity'] if 'lodDensity' in kwargs else 50000
+    self.lodSize = kwargs['lodSize'] if 'lodSize' in kwargs else 3
+    self.bins = kwargs['bins'] if 'bins' in kwargs else 256
+
+    # State
+    self.X = np.empty(0)
+    self.Y = np.empty(0)
+    self.A = np.empty(0)
+
+    # Colors: one [fill, stroke] pair per group, and group of each agent
+    self._colors = [['gray', 'white']]
+    self.group = np.zeros(0, dtype=int)
+
+    # Cached drawings, for each level of detail
+    self.cache = {}
+
+  def boundingRect(self):
+
+    m = self.d2scene(np.max(np.abs(self._points))) + self._thickness
+    w = self.d2scene(self.animation.boundaries['width'])
+    h = self.d2scene(self.animation.boundaries['height'])
+
+    return QRectF(-m, -h-m, w+2*m, h+2*m)
+
+  def detail(self, painter):
+    """
+    Level of detail to use with a given painter
+    """
+
+    if self.lod!='auto':
+      return self.lod
+
+    # Size of the polygons on screen (pixels)
+    size = self.d2scene(np.max(np.abs(self._points)))*QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+
+    if self.X.size>self.lodDensity:
+      return 'density'
+    elif self.X.size>self.lodPoints or size<self.lodSize:
+      return 'points'
+    else:
+      return 'polygons'
+
+  def paint(self, painter, option, widget=None):
+
+    lod = self.detail(painter)
+
+    if lod not in self.cache:
+      match lod:
+        case 'polygons': self.cache[lod] = self.polygons()
+        case 'points': self.cache[lod] = self.points()
+        case 'density': self.cache[lod] = self.density()
+
+    match lod:
+
+      case 'polygons':
+        for brush, pen, path in self.cache[lod]:
+          painter.setBrush(brush)
+          painter.setPen(pen)
+          painter.drawPath(path)
+
+      case 'points':
+        for pen, P in self.cache[lod]:
+          painter.setPen(pen)
+          painter.drawPoints(P)
+
+      case 'density':
+        rect, image = self.cache[lod]
+        painter.drawImage(rect, image)
+
+  def setColors(self, colors, group):
+    """
+    Set the colors of the agents
+
+    args:
+      colors (list): [fill, stroke] colors of each group.
+      group (array): Group index of each agent.
+    """
+
+    self._colors = colors
+    self.group = np.asarray(group, dtype=int)
+    self.cache = {}
+    self.update()
+
+  def setState(self, X, Y, A):
+    """
+    Set the positions and orientations of all agents
+    """
+
+    self.X = X
+    self.Y = Y
+    self.A = A
+
+    if self.group.size!=self.X.size:
+      self.group = np.zeros(self.X.size, dtype=int)
+
+    self.cache = {}
+    self.update()
+
+  def polygons(self):
+    """
+    Painter paths of all groups (brush, pen, path)
+    """
+
+    # Vertices (in scene coordinates)
+    Vx, Vy = self.poly2scene(self.X, self.Y, self.A, self._points)
+
+    paths = []
+    for g, (fill, stroke) in enumerate(self._colors):
+
+      I = self.group==g
+      if not np.any(I):
+        continue
+
+      pen = QPen(QColor(stroke))
+      pen.setWidth(self._thickness)
+
+      paths.append((QBrush(QColor(fill)), pen, polygonsPath(Vx[I], Vy[I])))
+
+    return paths
+
+  def points(self):
+    """
+    Point sets of all groups (pen, points)
+    """
+
+    P = self.xy2scene(np.column_stack((self.X, self.Y)))
+
+    points = []
+    for g, (fill, stroke) in enumerate(self._colors):
+
+      I = self.group==g
+      if not np.any(I):
+        continue
+
+      pen = QPen(QColor(fill))
+      pen.setWidth(max(self.lodSize, 1))
+      pen.setCosmetic(True)
+
+      points.append((pen, pointsPolygon(P[I])))
+
+    return points
+
+  def density(self):
+    """
+    Density map of the agents (target rectangle, image)
+    """
+
+    B = self.animation.boundaries
+
+    # 2D histogram (rows from top to bottom)
+    H, _, _ = np.histogram2d(self.Y, self.X, bins=self.bins, range=[B['y'], B['x']])
+    H = np.flipud(H)
+    if H.max()>0:
+      H /= H.max()
+
+    # Image (white or black, with the density as opacity)
+    c = 255 if self.animation.darkstyle else 0
+    self._image = np.empty(H.shape, dtype=np.uint32)
+    self._image[:] = (np.sqrt(H)*255).astype(np.uint32) << 24 | c << 16 | c << 8 | c
+    image = QImage(self._image.data, self.bins, self.bins, 4*self.bins, QImage.Format_ARGB32)
+
+    rect = QRectF(self.x2scene(B['x'][0]), self.y2scene(B['y'][1]), self.d2scene(B['width']), self.d2scene(B['height']))
+
+    return rect, image
+
+def polygonsPath(Vx, Vy):
+  """
+  Painter path made of many closed polygons with the same number of vertices
+
+  The path is deserialized from a binary array, which is much faster than
+  adding the polygons one by one.
+
+  args:
+    Vx, Vy (array): Coordinates of the vertices, of shape (n, number of vertices).
+
+  returns:
+    The QPainterPath.
+  """
+
+  n, k = Vx.shape
+
+  # Elements: a MoveTo followed by LineTo's, back to the first vertex
+  E = np.empty((n, k+1), dtype=[('type','>i4'), ('x','>f8'), ('y','>f8')])
+  E['type'] = 1
+  E['type'][:,0] = 0
+  E['x'][:,:k] = Vx
+  E['x'][:,k] = Vx[:,0]
+  E['y'][:,:k] = Vy
+  E['y'][:,k] = Vy[:,0]
+
+  # Element count, elements, start of current subpath and fill rule (winding)
+  data = QByteArray(np.array([E.size], dtype='>i4').tobytes() + E.tobytes() + np.array([0, 1], dtype='>i4').tobytes())
+
+  path = QPainterPath()
+  stream = QDataStream(data, QIODevice.ReadOnly)
+  stream >> path
+
+  return path
+
+def pointsPolygon(P):
+  """
+  Polygon of points, built in a single pass (binary serialization of
+  QPolygonF).
+
+  args:
+    P (array): (n,2) array of points.
+
+  returns:
+    The QPolygonF.
+  """
+
+  data = QByteArray(np.array([P.shape[0]], dtype='>u4').tobytes() + np.ascontiguousarray(P, dtype='>f8').tobytes())
+
+  polygon = QPolygonF()
+  stream = QDataStream(data, QIODevice.ReadOnly)
+  stream >> polygon
+
+  return polygon
+
 # === ANIMATION ============================================================
 
 class view(QGraphicsView):
@@ -620,7 +907,7 @@ class Animation2d():
 
 class Animation(Animation2d):
 
-  def __init__(self, window, N, darkstyle=True):
+  def __init__(self, window, N, darkstyle=True, data_in=None, seed=None):
 
     # Superclass constructor
     super().__init__(darkstyle=darkstyle)
@@ -628,50 +915,81 @@ class Animation(Animation2d):
     # Associated window
     self.window = window
 
-    # Associated enine
-    self.engine = Engine()
+    # Associated enine (replays the trajectory of data_in, if any)
+    self.engine = Engine(data_in=data_in, seed=seed)
 
-    # --- Items ------------------------------------------------------------
+    # --- Engine
 
-    self.N = N
+    if data_in is None:
+      self.engine.agents.add(N, 'Blind')
 
-    # --- Engine
+    # --- Items ------------------------------------------------------------
 
-    self.engine.agents.add(N, 'Blind')
+    self.N = self.engine.agents.N
 
     # --- Animation
 
     s = 0.011
 
-    for i in range(N):
+    self.add(swarm, 'swarm',
+      points = [[s,0],[-s/2,s/2],[-s/2,-s/2]],
+      thickness = 2
+    )
 
-      self.add(polygon, i, 
-        position = [self.engine.agents.list[i].x, self.engine.agents.list[i].y],
-        orientation = self.engine.agents.list[i].a,
-        points = [[s,0],[-s/2,s/2],[-s/2,-s/2]],
-        colors = ['red', 'red'],
-        thickness = 2
-      )
+    self.item['swarm'].setColors([['red', 'red']], np.zeros(self.N, dtype=int))
+    self.item['swarm'].setState(self.engine.agents.x.copy(), self.engine.agents.y.copy(), self.engine.agents.a.copy())
+
+    # --- Simulation thread
+
+    # Simulation rate (steps per second, None for as fast as possible, see
+    # rate)
+    self.worker = worker(self.engine, rate=self.fps)
+
+    # Positions of the last shuffle, for the colors (see shuffle)
+    self.hues = None
+
+  @property
+  def rate(self): return self.worker.rate
+
+  @rate.setter
+  def rate(self, value): self.worker.rate = value
+
+  def startAnimation(self):
+
+    self.worker.start()
+    super().startAnimation()
 
   def update(self):
 
+    # Failed simulation: stop the display and report the error
+    if self.worker.error is not None:
+      self.qtimer.stop()
+      print('→ Simulation stopped at iteration {:d}:'.format(self.engine.iteration))
+      traceback.print_exception(self.worker.error)
+      return
+
     if self.window.bPlay.isChecked():
+      self.worker.pause()
       return
 
+    self.worker.resume()
+
     # Superclass method
     super().update()
 
-    self.engine.step()
+    # Newest frame of the simulation
+    frame = self.worker.latest()
+    if frame is None:
+      return
 
-    for i in range(self.N):
+    _, X, Y, A = frame
 
-      # Position
-      x = self.engine.agents.list[i].x
-      y = self.engine.agents.list[i].y
-      self.item[i].position = [x, y]
+    # Colors of the last shuffle
+    if self.hues is not None:
+      self.colorize(self.hues)
+      self.hues = None
 
-      # Orientation
-      self.item[i].orientation = self.engine.agents.list[i].a
+    self.item['swarm'].setState(X, Y, A)
  
   def changeAgent(self):
 
@@ -684,26 +1002,34 @@ class Animation(Animation2d):
 
   def shuffle(self):
 
-    for i in range(self.N):
+    # Positions and orientations, drawn from the engine's generator between
+    # two steps of the simulation thread (which also uses it)
+    def place():
+      rng = self.engine.rng
+      self.engine.agents.x[:] = rng.random(self.N)
+      self.engine.agents.y[:] = rng.random(self.N)
+      self.engine.agents.a[:] = rng.random(self.N)*2*np.pi
+      self.hues = self.engine.agents.x.copy()
+
+    self.worker.call(place)
 
-      # Position
-      self.engine.agents.list[i].x = np.random.rand()
-      self.engine.agents.list[i].y = np.random.rand()
+  def colorize(self, X):
+    '''
+    Colors of the agents (hue bins of the positions X)
+    '''
 
-      # Orientation
-      self.engine.agents.list[i].a = np.random.rand()*2*np.pi
+    nc = 64
+    colors = []
+    for k in range(nc):
+      c = colorsys.hsv_to_rgb((k+0.5)/nc, 1, 1)
+      C = QColor(int(c[0]*255), int(c[1]*255), int(c[2]*255))
+      colors.append([C, C] if self.darkstyle else [C, QColor(0,0,0)])
 
-      # Colors
-      c = colorsys.hsv_to_rgb(self.engine.agents.list[i].x, 1, 1)
-      if self.darkstyle:
-        self.item[i].colors = [QColor(int(c[0]*255), int(c[1]*255), int(c[2]*255)), QColor(int(c[0]*255), int(c[1]*255), int(c[2]*255))]
-      else:
-        self.item[i].colors = [QColor(int(c[0]*255), int(c[1]*255), int(c[2]*255)), QColor(0,0,0)]
+    self.item['swarm'].setColors(colors, (X*nc).astype(int) % nc)
 
   def setSpeed(self):
 
-    for i in range(self.N):
-      self.engine.agents.list[i].v = self.window.sSpeed.value()*0.0002
+    self.engine.agents.set('v', self.window.sSpeed.value()*0.0002)
 
   # def setSigma_in(self):
 
@@ -712,16 +1038,14 @@ class Animation(Animation2d):
 
   def setSigma_out(self):
 
-    for i in range(self.N):
-      self.engine.agents.list[i].sigma_out = self.window.sSigma_out.value()*0.005
+    self.engine.agents.set('sigma_out', self.window.sSigma_out.value()*0.005)
 
   def setRadius(self):
 
     r = self.window.sRadius.value()*0.002
     self.window.lRadius.setText('{:.03f}'.format(r))
 
-    for i in range(self.N):
-      self.engine.agents.list[i].r = r
+    self.engine.agents.set('r', r)
 
   def setRrep(self):
 
@@ -734,8 +1058,7 @@ class Animation(Animation2d):
 
     self.window.lRrep.setText('{:.03f}'.format(r))
 
-    for i in range(self.N):
-      self.engine.agents.list[i].Rrep = r
+    self.engine.agents.set('Rrep', r)
 
   def setRal(self):
 
@@ -752,8 +1075,7 @@ class Animation(Animation2d):
 
     self.window.lRal.setText('{:.03f}'.format(r))
 
-    for i in range(self.N):
-      self.engine.agents.list[i].Ral = r
+    self.engine.agents.set('Ral', r)
 
   def setRatt(self):
 
@@ -765,16 +1087,14 @@ class Animation(Animation2d):
 
     self.window.lRatt.setText('{:.03f}'.format(r))
 
-    for i in range(self.N):
-      self.engine.agents.list[i].Ratt = r
+    self.engine.agents.set('Ratt', r)
 
   def setAlpha(self):
 
     a = self.window.salpha.value()*np.pi/200
     self.window.lalpha.setText('{:.03f}'.format(a))
 
-    for i in range(self.N):
-      self.engine.agents.list[i].alpha = a
+    self.engine.agents.set('alpha', a)
 
   def symmetrize(self):
 
@@ -812,11 +1132,7 @@ class Animation(Animation2d):
     self.window.lw3.setText('0.00')
     self.window.lw4.setText('0.00')
 
-    for i in range(self.N):
-      self.engine.agents.list[i].w1 = 0
-      self.engine.agents.list[i].w2 = 0
-      self.engine.agents.list[i].w3 = 0
-      self.engine.agents.list[i].w4 = 0
+    self.engine.params.set('W', np.zeros(self.engine.agents.ns))
 
   def setW1(self):
 
@@ -824,8 +1140,7 @@ class Animation(Animation2d):
     w1 = (self.window.sw1.value()-50)/50
     self.window.lw1.setText('{:.02f}'.format(w1))
 
-    for i in range(self.N):
-      self.engine.agents.list[i].w1 = w1
+    self.engine.agents.set('w1', w1)
 
     # Symmetrize values
     if self.window.cSym.isChecked():
@@ -837,8 +1152,7 @@ class Animation(Animation2d):
     w2 = (self.window.sw2.value()-50)/50
     self.window.lw2.setText('{:.02f}'.format(w2))
 
-    for i in range(self.N):
-      self.engine.agents.list[i].w2 = w2
+    self.engine.agents.set('w2', w2)
 
     # Symmetrize values
     if self.window.cSym.isChecked():
@@ -850,8 +1164,7 @@ class Animation(Animation2d):
     w3 = (self.window.sw3.value()-50)/50
     self.window.lw3.setText('{:.02f}'.format(w3))
 
-    for i in range(self.N):
-      self.engine.agents.list[i].w3 = w3
+    self.engine.agents.set('w3', w3)
 
   def setW4(self):
 
@@ -859,13 +1172,11 @@ class Animation(Animation2d):
     w4 = (self.window.sw4.value()-50)/50
     self.window.lw4.setText('{:.02f}'.format(w4))
 
-    for i in range(self.N):
-      self.engine.agents.list[i].w4 = w4
+    self.engine.agents.set('w4', w4)
 
   def setDelta(self):
 
     delta = (self.window.sdelta.value()-50)*np.pi/50
     self.window.ldelta.setText('{:.02f}'.format(delta))
 
-    for i in range(self.N):
-      self.engine.agents.list[i].delta = delta
\ No newline at end of file
+    self.engine.agents.set('delta', delta)
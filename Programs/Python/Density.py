@@ -0,0 +1,88 @@
+'''
+Kernel density estimation on periodic domains
+
+Densities are estimated on regular grids with Gaussian kernels: the
+samples are deposited on the grid (cloud-in-cell), convolved with the
+kernel by FFT and interpolated back at the samples. The cost is about
+O(G log G + N) instead of O(N²) for a direct estimation.
+'''
+
+import numpy as np
+
+# === Grid operations ======================================================
+
+def deposit(U, G):
+  '''
+  Linear (cloud-in-cell) deposit on a periodic 1D grid
+
+  U are the positions in grid units. Returns the lower node index and the
+  weight of the upper node for each sample.
+  '''
+
+  I = np.floor(U)
+  return I.astype(int) % G, U - I
+
+def kernel(G, sigma):
+  '''
+  Fourier transform of a Gaussian kernel of width sigma (in grid units) on
+  a periodic 1D grid of G nodes
+  '''
+
+  k = np.fft.fftfreq(G)
+  return np.exp(-2*(np.pi*sigma*k)**2)
+
+# === Position =============================================================
+
+def position(X, Y, sigma, G=128):
+  '''
+  Density of positions on the periodic unit square, at each sample.
+
+  The density is normalized as a probability density (its integral over
+  the square is 1), so it is 1 everywhere for uniformly spread agents.
+  '''
+
+  N = X.size
+
+  # Deposit
+  i, fx = deposit(X*G, G)
+  j, fy = deposit(Y*G, G)
+  i1 = (i+1) % G
+  j1 = (j+1) % G
+
+  H = np.bincount(i*G + j, weights=(1-fx)*(1-fy), minlength=G*G) \
+    + np.bincount(i1*G + j, weights=fx*(1-fy), minlength=G*G) \
+    + np.bincount(i*G + j1, weights=(1-fx)*fy, minlength=G*G) \
+    + np.bincount(i1*G + j1, weights=fx*fy, minlength=G*G)
+
+  # Convolution
+  K = kernel(G, sigma*G)
+  D = np.fft.irfft2(np.fft.rfft2(H.reshape((G,G)))*K[:,None]*K[None,:G//2+1], s=(G,G))
+  D *= G**2/N
+
+  # Interpolation
+  return D[i,j]*(1-fx)*(1-fy) + D[i1,j]*fx*(1-fy) + D[i,j1]*(1-fx)*fy + D[i1,j1]*fx*fy
+
+# === Orientation ==========================================================
+
+def orientation(A, sigma, G=256):
+  '''
+  Density of orientations on the circle, at each sample.
+
+  The density is normalized as a probability density over [0,2pi), so it
+  is 1/(2pi) everywhere for uniformly spread orientations.
+  '''
+
+  N = A.size
+
+  # Deposit
+  i, f = deposit(np.mod(A, 2*np.pi)*G/2/np.pi, G)
+  i1 = (i+1) % G
+
+  H = np.bincount(i, weights=1-f, minlength=G) + np.bincount(i1, weights=f, minlength=G)
+
+  # Convolution
+  D = np.fft.irfft(np.fft.rfft(H)*kernel(G, sigma*G/2/np.pi)[:G//2+1], n=G)
+  D *= G/2/np.pi/N
+
+  # Interpolation
+  return D[i]*(1-f) + D[i1]*f
@@ -1,9 +1,14 @@
-import random
 from math import *
 import numpy as np
 import time
+import threading
+from collections import deque
 
-RNG = np.random.default_rng()
+import Kernels
+import Jit
+import Neighbors
+import Storage
+import Density
 
 # === Geometry =============================================================
 
@@ -16,10 +21,28 @@ class foop:
     self.Y = Y
     self.A = A
 
-  def center(self, tx, ty, ta=0):
+    # Neighbor index and pair list
+    self.index = None
+    self.pairs = None
+
+    # Cosines and sines of the orientations (see trig)
+    self.cs = None
+
+  def trig(self):
+    '''
+    Cosines and sines of the orientations of all points, computed once
+    '''
+
+    if self.cs is None:
+      self.cs = (np.cos(self.A), np.sin(self.A))
+
+    return self.cs
+
+  def center(self, tx, ty, ta=0, cs=None):
     '''
     (tx,ty) is the target position, which will be at (0,0) after translation
     ta is the target angle, which will be at 0 after rotation
+    cs is the optional (cos(ta), sin(ta)) pair, if already known
     '''
 
     # Translation (with boundary conditions)
@@ -28,10 +51,8 @@ class foop:
 
     # Rotation
     if ta!=0:
-      Z = X+Y*1j
-      Z = np.abs(Z)*np.exp(1j*(np.angle(Z)-ta))
-      X = np.real(Z)
-      Y = np.imag(Z)
+      c, s = (np.cos(ta), np.sin(ta)) if cs is None else cs
+      X, Y = X*c + Y*s, Y*c - X*s
 
     return foop(X, Y, self.A-ta)
 
@@ -57,65 +78,105 @@ class foop:
     Save data points
     '''
 
-    file.pos[step,:,0] = self.X
-    file.pos[step,:,1] = self.Y
-    file.pos[step,:,2] = self.A
+    file.write(step, self.X, self.Y, self.A)
 
 # === Generic mobile agents ================================================
 
+class field:
+  '''
+  Agent attribute stored in the swarm arrays (see Agents)
+  '''
+
+  def __set_name__(self, owner, name):
+    self.name = name
+
+  def __get__(self, obj, objtype=None):
+    if obj is None:
+      return self
+    return getattr(obj.engine.agents, self.name)[obj.i]
+
+  def __set__(self, obj, value):
+    if self.name in Agents.state:
+      getattr(obj.engine.agents, self.name)[obj.i] = value
+    else:
+      obj.engine.params.override(self.name)[obj.i] = value
+
+class weight:
+  '''
+  Perceptron weight of the k-th sector, stored in the swarm weights array
+  '''
+
+  def __init__(self, k):
+    self.k = k
+
+  def __get__(self, obj, objtype=None):
+    if obj is None:
+      return self
+    return obj.engine.agents.W[obj.i, self.k]
+
+  def __set__(self, obj, value):
+    obj.engine.params.override('W')[obj.i, self.k] = value
+
 class agent:
   '''
-  Generic mobile agent (parent class)  
+  Generic mobile agent
+
+  Thin view on the i-th row of the swarm arrays held by Agents. The state
+  and parameters are not stored here, but all attributes can still be read
+  and set individually.
   '''
 
-  def __init__(self, engine, v=0.006, sigma=0.05, r=0.05, damax=None, initial_position=None):
+  # State
+  x = field()
+  y = field()
+  a = field()
 
-    # Definitions
+  # Definitions
+  v = field()
+  sigma_out = field()
+  damax = field()
+  delta = field()
+
+  # Viscek
+  r = field()
+
+  # Aoki-Couzin
+  Rrep = field()
+  Ral = field()
+  Ratt = field()
+  alpha = field()
 
+  # Percepton
+  w1 = weight(0)
+  w2 = weight(1)
+  w3 = weight(2)
+  w4 = weight(3)
+
+  def __init__(self, engine, i):
+
+    # Definitions
     self.engine = engine
-    self.v = v
-    # self.sigma_in = sigma
-    self.sigma_out = sigma
-    self.damax = damax if damax is not None else np.pi/6
-    self.delta = 0
-
-    # Viscek
-    self.r = r
-
-    # Aoki-Couzin
-    self.Rrep = 0.005
-    self.Ral = 0.125
-    self.Ratt = 0.25
-    self.alpha = np.pi/4
-
-    # Percepton
-    self.ns = 4
-    self.w1 = 0
-    self.w2 = 0
-    self.w3 = 0
-    self.w4 = 0
-
-    # Initial position
-    if initial_position is None:
-      self.x = random.random()
-      self.y = random.random()
-      self.a = random.random()*2*np.pi
-    else:
-      self.x = initial_position[0]
-      self.y = initial_position[1]
-      self.a = initial_position[2]
+    self.i = i
 
     # Polar coordinates
     self.rho = None
     self.theta = None
 
-    # Density
-    self.density = {'pos':[], 'ang':[]}
-    self.kde_sigma = {'pos':None, 'ang':None}
-
     # Blind list
     self.blindlist = None
 
+  @property
+  def ns(self): return self.engine.agents.ns
+
+  @property
+  def w(self): return self.engine.agents.W[self.i]
+
+  @property
+  def density(self): return {key: val[self.i] for key, val in self.engine.agents.density.items()}
+
+  @property
+  def kde_sigma(self): return self.engine.kde_sigma
+
   def __str__(self):
 
     if self.__class__.__name__ == 'agent':
@@ -123,6 +184,11 @@ class agent:
     else:
       s = '--- ' + str(self.__class__.__name__) + ' agent ---'
 
+    for key in Agents.fields:
+      s+= '\n' + key + ': ' + str(getattr(self, key))
+
+    s+= '\nw: ' + str(self.w)
+
     for key,val in self.__dict__.items():
       s+= '\n' + key + ': ' + str(val)
 
@@ -133,31 +199,61 @@ class agent:
     Updating perception of the surroundings
 
     - Sets density field in polar coordinates around the agent
-    - Computes the local density, used for the fitness
+
+    The local densities, used for the fitness, are estimated for all agents
+    at once by the engine (see Engine.kde).
     '''
 
-    # Center around agent
-    if reorient:
-      C = F.center(self.x, self.y, self.a)
-    else:
-      C = F.center(self.x, self.y)
+    # Pair list of the step
+    if F.pairs is not None and F.pairs.r>=r:
 
-    # Polar coordinates
-    Z = C.X + C.Y*1j
+      k = F.pairs.neighbors(self.i)
+      K = F.pairs.rho[k]<=r
+      I = F.pairs.J[k][K]
+      rho = F.pairs.rho[k][K]
+      theta = F.pairs.theta[k][K] if reorient else np.mod(F.pairs.phi[k][K], 2*np.pi)
 
-    # --- Density
+      if include_self:
+        I = np.concatenate(([self.i], I))
+        rho = np.concatenate(([0], rho))
+        theta = np.concatenate(([0], theta))
 
-    # Find nearest neighbors
-    I = C.near(0.5, blindlist=self.blindlist, include_self=include_self)
+    else:
 
-    # --- Polar coordinates
+      # Candidate neighbors
+      if F.index is None:
+        I = np.arange(F.X.size)
+      else:
+        I = F.index.near(self.x, self.y, r)
+
+      # Center around agent (with the cosines and sines of the step)
+      C = foop(F.X[I], F.Y[I], F.A[I])
+      if reorient:
+        c, s = F.trig()
+        C = C.center(self.x, self.y, self.a, (c[self.i], s[self.i]))
+      else:
+        C = C.center(self.x, self.y)
+
+      # Find nearest neighbors
+      K = C.near(r, include_self=include_self)
+      I = I[K]
+
+      # Polar coordinates
+      Z = C.X[K] + C.Y[K]*1j
+      rho = np.abs(Z)
+      theta = np.mod(np.angle(Z), 2*np.pi)
+
+    # Remove blindlist
+    if self.blindlist is not None:
+      K = np.isin(I, self.blindlist, invert=True)
+      I = I[K]
+      rho = rho[K]
+      theta = theta[K]
 
-    # Find nearest neighbors
-    if r!=0.5:
-      I = C.near(r, blindlist=self.blindlist, include_self=include_self)
+    # --- Polar coordinates
 
-    self.rho = np.abs(Z[I])
-    self.theta = np.mod(np.angle(Z[I]), 2*np.pi)
+    self.rho = rho
+    self.theta = theta
 
     return I
 
@@ -167,11 +263,11 @@ class agent:
     '''
 
     # Angular noise
-    self.a += self.sigma_out*RNG.standard_normal(1)
+    self.a += self.sigma_out*self.engine.rng.standard_normal()
 
     # Position
-    self.x = ((self.x + self.v*np.cos(self.a)) % 1)[0]
-    self.y = ((self.y + self.v*np.sin(self.a)) % 1)[0]
+    self.x = (self.x + self.v*np.cos(self.a)) % 1
+    self.y = (self.y + self.v*np.sin(self.a)) % 1
 
   def update(self, i, F):
     
@@ -225,7 +321,7 @@ class agent:
           
         else:
 
-          if Nal & Natt:
+          if Nal and Natt:
 
             dal = np.angle(np.sum(np.exp(1j*beta[Ial])))
             dal = np.mod(dal - self.a + np.pi, 2*np.pi) - np.pi
@@ -274,24 +370,174 @@ class agent:
             v.append(0)
 
         # Renormalization
-        v /= np.sum(v)
+        v = np.array(v)
+        if np.sum(v):
+          v /= np.sum(v)
 
         # Update angle
-        self.a += np.tanh(self.w1*v[0] + self.w2*v[1] + self.w3*v[2] + self.w4*v[3])*self.damax
+        self.a += np.tanh(np.dot(self.w, v))*self.damax
 
         # Add angular noise and move    
         self.move()
 
+# === Parameters ===========================================================
+
+class parameters:
+  '''
+  Parameters of the agents
+
+  Each parameter is held once, as a value shared by all agents, unless it
+  has been set for individual agents, in which case it is stored as a
+  per-agent array (override). Changing a shared value thus costs O(1)
+  whatever the number of agents, while heterogeneous swarms are still
+  possible.
+
+  Parameters are read as arrays of one value per agent (see Agents); shared
+  values are broadcast, without copy.
+  '''
+
+  def __init__(self, engine):
+
+    self.engine = engine
+
+    # Shared values
+    self.shared = {key: float(val) for key, val in Agents.fields.items() if key not in Agents.state}
+
+    # Perceptron weights (one per perception sector)
+    self.shared['W'] = np.zeros(4)
+
+    # Per-agent overrides
+    self.local = {}
+
+  def __getitem__(self, key):
+
+    if key in self.local:
+      return self.local[key]
+
+    val = np.asarray(self.shared[key], dtype=self.engine.agents.dtype)
+    return np.broadcast_to(val, (self.engine.agents.N,) + val.shape)
+
+  def set(self, key, value):
+    '''
+    Set a parameter for all agents: either a shared value, or an array of
+    one value per agent.
+    '''
+
+    if np.ndim(value)>np.ndim(self.shared[key]):
+      self.local[key] = np.array(np.broadcast_to(value, self[key].shape), dtype=self.engine.agents.dtype)
+    else:
+      self.shared[key] = np.array(value, dtype=float) if np.ndim(value) else float(value)
+      self.local.pop(key, None)
+
+  def override(self, key):
+    '''
+    Per-agent array of a parameter, created from the shared value if needed
+    '''
+
+    if key not in self.local:
+      self.local[key] = np.array(self[key])
+
+    return self.local[key]
+
+  def max(self, key):
+    '''
+    Largest value of a parameter over all agents
+    '''
+
+    return np.max(self.local[key]) if key in self.local else np.max(self.shared[key])
+
+  def extend(self, n):
+    '''
+    Extend the overrides for n new agents, with the shared values
+    '''
+
+    for key, val in self.local.items():
+      self.local[key] = np.concatenate((val, np.broadcast_to(self.shared[key], (n,) + val.shape[1:])), dtype=val.dtype)
+
+  def take(self, K):
+    '''
+    Reorder the agents of the overrides
+    '''
+
+    for key, val in self.local.items():
+      self.local[key] = val[K]
+
+class parameter:
+  '''
+  Swarm parameter held by the parameter store of the engine (see
+  parameters), read as an array of one value per agent
+  '''
+
+  def __set_name__(self, owner, name):
+    self.name = name
+
+  def __get__(self, obj, objtype=None):
+    if obj is None:
+      return self
+    return obj.engine.params[self.name]
+
+  def __set__(self, obj, value):
+    obj.engine.params.set(self.name, value)
+
 # === List of agents =======================================================
 
 class Agents:
   '''
   Collection of agents
+
+  The state of the swarm is stored as contiguous arrays (structure of
+  arrays), one element per agent, and the parameters in the parameter store
+  of the engine. The list of agent objects is kept as a set of views on
+  these arrays.
   '''
 
-  def __init__(self, engine):
+  # State arrays
+  state = ('x', 'y', 'a')
+
+  # Parameters
+  v = parameter()
+  sigma_out = parameter()
+  damax = parameter()
+  delta = parameter()
+  r = parameter()
+  Rrep = parameter()
+  Ral = parameter()
+  Ratt = parameter()
+  alpha = parameter()
+  W = parameter()
+
+  # Per-agent values and their default values
+  fields = {
+    'x': None,
+    'y': None,
+    'a': None,
+    'v': 0.006,
+    'sigma_out': 0.05,
+    'damax': np.pi/6,
+    'delta': 0,
+    'r': 0.05,
+    'Rrep': 0.005,
+    'Ral': 0.125,
+    'Ratt': 0.25,
+    'alpha': np.pi/4}
+
+  def __init__(self, engine, dtype=np.float64):
     self.N = 0
     self.list = []
+
+    # Precision of the state and parameters (np.float64 or np.float32)
+    self.dtype = np.dtype(dtype)
+
+    # State arrays
+    for key in self.state:
+      setattr(self, key, np.empty(0, dtype=self.dtype))
+
+    # Second buffer of the state (see _swap) and scratch arrays
+    self.field = foop(*[np.empty(0, dtype=self.dtype) for key in self.state])
+    self.buffers = {}
+
+    # Local densities of positions and orientations (see Engine.kde)
+    self.density = {'pos': np.empty(0), 'ang': np.empty(0)}
         
     # Engine
     self.engine = engine
@@ -301,27 +547,180 @@ class Agents:
     s += 'N: ' + str(self.N)
     return s
 
-  def add(self, n, type):
+  # --- Perception sectors -------------------------------------------------
+
+  @property
+  def ns(self): return self.engine.params.shared['W'].size
+
+  @ns.setter
+  def ns(self, n):
+    '''
+    Change the number of perception sectors of the Perceptron model. Existing
+    weights are kept, new sectors have zero weight.
+    '''
+
+    P = self.engine.params
+    k = min(n, self.ns)
+
+    W = np.zeros(n)
+    W[:k] = P.shared['W'][:k]
+    P.shared['W'] = W
+
+    if 'W' in P.local:
+      W = np.zeros((self.N, n), dtype=self.dtype)
+      W[:,:k] = P.local['W'][:,:k]
+      P.local['W'] = W
+
+  def add(self, n, type, initial_position=None):
     '''
     Add one or many agents
+
+    initial_position is an optional (n,3) array of positions and orientations.
     '''
-        
-    # Add agents
-    for i in range(n):
-      self.list.append(agent(self.engine))
+
+    # Initial positions
+    if initial_position is None:
+      rng = self.engine.rng
+      initial_position = np.column_stack((rng.random(n), rng.random(n), rng.random(n)*2*np.pi))
+    else:
+      initial_position = np.reshape(initial_position, (n,3))
+
+    # Extend arrays
+    for k, key in enumerate(self.state):
+      setattr(self, key, np.concatenate((getattr(self, key), initial_position[:,k]), dtype=self.dtype))
+
+    self.engine.params.extend(n)
+
+    # Agent views
+    for i in range(self.N, self.N+n):
+      self.list.append(agent(self.engine, i))
 
     # Update agent count
-    self.N = n
+    self.N += n
+
+    # Densities are not estimated yet
+    self.density = {'pos': np.full(self.N, np.nan), 'ang': np.full(self.N, np.nan)}
     
   def compile(self):
     '''
-    Compile all positions and orientations
+    Compile all positions and orientations (copies of the state)
+    '''
+
+    return foop(self.x.copy(), self.y.copy(), self.a.copy())
+
+  def _swap(self):
     '''
+    Field of the step, without copy (used by the engine steps only)
+
+    The state is double-buffered: the current state arrays become the field
+    of the step, which is only read during the step, and the arrays of the
+    previous field are recycled as state arrays. The new state has to be
+    written entirely in the state arrays (see move), or be initialized with
+    restore().
+    '''
+
+    F = self.field
+
+    # Buffers
+    if F.X.size!=self.N:
+      F.X = np.empty(self.N, dtype=self.dtype)
+      F.Y = np.empty(self.N, dtype=self.dtype)
+      F.A = np.empty(self.N, dtype=self.dtype)
+
+    # Swap
+    F.X, self.x = self.x, F.X
+    F.Y, self.y = self.y, F.Y
+    F.A, self.a = self.a, F.A
+
+    F.index = None
+    F.pairs = None
+    F.cs = None
+
+    return F
+
+  def buffer(self, key, shape, dtype=float):
+    '''
+    Scratch array, kept from one step to the next. Its content is not
+    preserved.
+    '''
+
+    shape = (shape,) if np.isscalar(shape) else tuple(shape)
+    B = self.buffers.get(key)
+
+    if B is None or B.shape!=shape or B.dtype!=dtype:
+      B = self.buffers[key] = np.empty(shape, dtype=dtype)
+
+    return B
+
+  def noise(self):
+    '''
+    Standard normal draws for all agents, in a scratch array
+    '''
+
+    t = self.buffer('noise', self.N, self.dtype)
+    self.engine.rng.standard_normal(out=t, dtype=self.dtype)
+    return t
+
+  def restore(self, F):
+    '''
+    Copy the field of the step in the state arrays
+    '''
+
+    np.copyto(self.x, F.X)
+    np.copyto(self.y, F.Y)
+    np.copyto(self.a, F.A)
+
+  def set(self, key, value):
+    '''
+    Set the parameter key (e.g. 'v', 'r' or 'w1') of all agents, to a single
+    value shared by all agents or to an array of one value per agent.
+    '''
+
+    P = self.engine.params
+
+    if key in ('w1', 'w2', 'w3', 'w4'):
+
+      k = int(key[1])-1
+
+      if np.ndim(value) or 'W' in P.local:
+        P.override('W')[:,k] = value
+      else:
+        W = P.shared['W'].copy()
+        W[k] = value
+        P.set('W', W)
+
+    elif key in self.fields and key not in self.state:
+      P.set(key, value)
+
+    else:
+      raise AttributeError("Unknown agent parameter '{:s}'.".format(key))
+
+  def move(self, F=None):
+    '''
+    Move all agents at once (with bounday conditions)
+
+    The noise is added to the orientations of the state arrays, and the
+    agents move from the positions of the field F of the step, if given
+    (see _swap), or of the state arrays.
+    '''
+
+    X, Y = (self.x, self.y) if F is None else (F.X, F.Y)
+
+    # Angular noise
+    t = self.noise()
+    t *= self.sigma_out
+    self.a += t
+
+    # Position
+    np.cos(self.a, out=t)
+    t *= self.v
+    np.add(X, t, out=self.x)
+    np.mod(self.x, 1, out=self.x)
 
-    return foop(
-      np.array([A.x for A in self.list],dtype=object).flatten().astype(float),
-      np.array([A.y for A in self.list],dtype=object).flatten().astype(float),
-      np.array([A.a for A in self.list],dtype=object).flatten().astype(float))
+    np.sin(self.a, out=t)
+    t *= self.v
+    np.add(Y, t, out=self.y)
+    np.mod(self.y, 1, out=self.y)
 
 # === Engine ===============================================================
 
@@ -331,13 +730,29 @@ class Engine:
   '''
 
   # Contructor
-  def __init__(self, steps=None, data_in=None, data_out=None):
+  def __init__(self, steps=None, data_in=None, data_out=None, neighbors='auto', skin=None, seed=None, dtype=np.float64):
 
     # Mode
     self.mode = 'Blind'
 
-    # Agents
-    self.agents = Agents(self)
+    # Random number generator (seed can be an int or a SeedSequence)
+    self.seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    self.rng = np.random.default_rng(self.seed)
+
+    # Neighbor search method ('auto', 'brute', 'grid' or 'tree')
+    self.neighbors = neighbors
+
+    # Verlet list skin (None to search the neighbors at each step)
+    self.skin = skin
+    self.verlet = None
+
+    # Model kernels ('numpy', or 'numba' for the compiled kernels if numba
+    # is installed)
+    self.backend = 'numpy'
+
+    # Agents and their parameters (shared values and per-agent overrides)
+    self.params = parameters(self)
+    self.agents = Agents(self, dtype)
 
     # --- Iterations
 
@@ -354,40 +769,399 @@ class Engine:
     # Input file
     self.data_in = data_in
 
+    # --- Replay
+
+    # Playback speed (steps per frame, can be fractional or negative)
+    self.speed = 1
+    self.position = 0
+
+    if data_in is None:
+      self.replay = None
+
+    else:
+      self.replay = Storage.reader(data_in)
+      self.mode = str(self.replay.attrs.get('mode', self.mode))
+      self.agents.add(self.replay.N, self.mode, initial_position=self.replay.frame(0))
+
     # Output file
     self.data_out = data_out
+    self.storage = None
 
     # --- Density estimation
 
+    # Estimate the local densities at each step
+    self.kde = False
+
     # Density estimation lengths
     self.kde_sigma = {'pos': 0.1, 'ang':np.pi/10}
 
+    # Density estimation grid sizes
+    self.kde_grid = {'pos': 128, 'ang': 256}
+
+    # --- Observables
+
+    # Observables computed at each step (see Observables.observables)
+    self.observables = None
+
+  def streams(self, n):
+    '''
+    n independent random number generators spawned from the seed of the
+    engine, e.g. one per agent or one per replica.
+    '''
+
+    return [np.random.default_rng(s) for s in self.seed.spawn(n)]
+
+  def radius(self):
+    '''
+    Largest interaction radius in use for the current mode
+    '''
+
+    match self.mode:
+      case 'Vicsek': return self.params.max('r')
+      case 'Aoki-Couzin': return min(self.params.max('Ratt'), 0.5)
+      case 'Perceptron': return 0.5
+      case _: return None
+
+  def seek(self, step):
+    '''
+    Go to a given step of the replayed trajectory (looping at the end)
+    '''
+
+    self.position = step % len(self.replay)
+    self.iteration = int(self.position)
+
+    P = self.replay.frame(self.iteration)
+    self.agents.x[:] = P[:,0]
+    self.agents.y[:] = P[:,1]
+    self.agents.a[:] = P[:,2]
+
   def step(self):
     '''
     One step of the simulation
     '''
 
+    # Replay: no simulation, next frame of the input file
+    if self.replay is not None:
+      self.seek(self.position + self.speed)
+      return
+
     if self.verbose is not None and (self.iteration % self.verbose)==0:
       print('→ Iteration {:d} ({:.2f} s) ...'.format(self.iteration, time.time()-self.tref))
 
     # Prepare data
-    F = self.agents.compile()
+    F = self.agents._swap()
+
+    # Save data
+    if self.data_out is not None:
+
+      if self.storage is None:
+        self.storage = Storage.writer(self.data_out, self.agents.N, steps=self.steps, dtype=self.agents.dtype, mode=self.mode)
+
+      F.save(self.storage, self.iteration)
+
+    # Compiled kernels (with their own neighbor search)
+    jit = self.backend=='numba' and Jit.numba is not None and self.mode in Jit.modes
+
+    # Neighbors (the kernels reduce the pairs by blocks when the pair list
+    # would exceed the memory budget, see Kernels.neighborhoods)
+    R = self.radius()
+    if R is not None and not jit and not Neighbors.large(self.agents.N, R):
+
+      if self.skin is None:
+        F.index = Neighbors.index(F, R, self.neighbors)
+
+      else:
+        if self.verlet is None or self.verlet.skin!=self.skin or self.verlet.method!=self.neighbors:
+          self.verlet = Neighbors.verlet(self.skin, self.neighbors)
+        F.index = self.verlet.update(F, R)
+
+      F.pairs = Neighbors.pairlist(F, R, F.index)
+
+    # Local densities
+    if self.kde:
+      self.agents.density['pos'] = Density.position(F.X, F.Y, self.kde_sigma['pos'], self.kde_grid['pos'])
+      self.agents.density['ang'] = Density.orientation(F.A, self.kde_sigma['ang'], self.kde_grid['ang'])
+
+    # Observables
+    if self.observables is not None:
+      self.observables.compute(F)
 
     # --- Update
 
-    for i, agent in enumerate(self.agents.list):
-      agent.update(self.iteration, F)
+    K = Jit if jit else Kernels
+
+    match self.mode:
+
+      case 'Blind':
+        np.copyto(self.agents.a, F.A)
+        self.agents.move(F)
+
+      case 'Vicsek':
+        K.vicsek(self.agents, F)
+
+      case 'Aoki-Couzin':
+        K.aoki_couzin(self.agents, F)
+
+      case 'Perceptron':
+        K.perceptron(self.agents, F)
+
+      case _:
+        self.agents.restore(F)
+        raise ValueError("Unknown mode '{:s}'.".format(self.mode))
 
     # --- End of simulation
 
-    if self.steps is not None and self.iteration==self.steps-1:
+    if self.verbose and self.steps is not None and self.iteration==self.steps-1:
+      print('→ End of simulation @ {:d} steps ({:.2f} s)'.format(self.steps, time.time()-self.tref))
+
+    self.iteration += 1
+
+  def close(self):
+    '''
+    Close the input and output files, if any. The output file is kept open
+    until then, so that a simulation can be continued by further steps or
+    runs.
+    '''
+
+    if self.storage is not None:
+      self.storage.close()
+
+    if self.replay is not None:
+      self.replay.close()
+
+  def run(self, steps=None):
+    '''
+    Run the simulation as fast as possible, without display, until the
+    total number of steps is reached.
+    '''
+
+    if steps is not None:
+      self.steps = steps
+
+    if self.steps is None:
+      raise ValueError('The number of steps must be specified for a run.')
+
+    if self.tref is None:
+      self.tref = time.time()
 
-      # End of simulation
-      if self.verbose:
-        print('→ End of simulation @ {:d} steps ({:.2f} s)'.format(self.steps, time.time()-self.tref))
+    while self.iteration<self.steps:
+      self.step()
+
+    # Write the buffered steps
+    if self.storage is not None:
+      self.storage.flush()
+
+    return self
+
+# === Ensemble engine ======================================================
+
+class Ensemble(Engine):
+  '''
+  Ensemble of R independent replicas of a swarm, run in lockstep
+
+  The swarm arrays hold the R replicas one after the other, so that the
+  batched kernels update all the replicas in a single pass, with
+  independent noise for each agent of each replica. Only the agents of
+  the same replica interact (see Neighbors.replicas). The state can be
+  viewed with a leading replica axis, of shape (R,N).
+
+  Only the batched modes are supported, without storage, densities or
+  observables.
+  '''
+
+  def __init__(self, R, steps=None, neighbors='auto', seed=None, dtype=np.float64):
+
+    super().__init__(steps=steps, neighbors=neighbors, seed=seed, dtype=dtype)
+
+    # Number of replicas
+    self.R = R
+
+  @property
+  def N(self):
+    '''
+    Number of agents per replica
+    '''
+
+    return self.agents.N//self.R
+
+  def add(self, n, type, initial_position=None):
+    '''
+    Add n agents to each replica
+
+    initial_position is an optional (R,n,3) array of positions and
+    orientations.
+    '''
+
+    N = self.N
+
+    if initial_position is not None:
+      initial_position = np.reshape(initial_position, (self.R*n, 3))
+
+    self.agents.add(self.R*n, type, initial_position=initial_position)
+
+    # Keep the replicas contiguous
+    K = np.concatenate((np.arange(self.R*N).reshape((self.R, N)),
+      self.R*N + np.arange(self.R*n).reshape((self.R, n))), axis=1).flatten()
+
+    for key in self.agents.state:
+      setattr(self.agents, key, getattr(self.agents, key)[K])
+    self.params.take(K)
+
+  def state(self, key='a'):
+    '''
+    View of the array key (e.g. 'x', 'y', 'a' or 'sigma_out') of the swarm,
+    of shape (R,N). Modifications of the view apply to the swarm.
+    '''
+
+    return getattr(self.agents, key).reshape((self.R, self.N))
+
+  def step(self):
+    '''
+    One step of all the replicas
+    '''
+
+    if self.verbose is not None and (self.iteration % self.verbose)==0:
+      print('→ Iteration {:d} ({:.2f} s) ...'.format(self.iteration, time.time()-self.tref))
+
+    # Prepare data
+    F = self.agents._swap()
+
+    # Neighbors
+    r = self.radius()
+    if r is not None:
+      F.index = Neighbors.replicas(F, self.R, r, self.neighbors)
+      F.pairs = Neighbors.pairlist(F, r, F.index)
+
+    # --- Update
+
+    match self.mode:
+
+      case 'Blind':
+        np.copyto(self.agents.a, F.A)
+        self.agents.move(F)
+
+      case 'Vicsek':
+        Kernels.vicsek(self.agents, F)
+
+      case 'Aoki-Couzin':
+        Kernels.aoki_couzin(self.agents, F)
+
+      case 'Perceptron':
+        Kernels.perceptron(self.agents, F)
+
+      case _:
+        raise ValueError("Mode '{:s}' is not supported by ensembles.".format(self.mode))
+
+    # --- End of simulation
+
+    if self.verbose and self.steps is not None and self.iteration==self.steps-1:
+      print('→ End of simulation @ {:d} steps ({:.2f} s)'.format(self.steps, time.time()-self.tref))
 
     self.iteration += 1
 
- 
-    
-    
+# === Background worker ====================================================
+
+class worker:
+  '''
+  Runs the engine in a background thread
+
+  The positions and orientations after each step are pushed into a bounded
+  ring buffer, from which the display only takes the newest frame. The
+  simulation rate (steps per second, None for as fast as possible) is thus
+  independent of the display framerate, and can be changed at any time.
+
+  If a step raises an exception, the thread stops and the exception is
+  kept in error, for the display to report it.
+  '''
+
+  def __init__(self, engine, rate=None, size=4):
+
+    self.engine = engine
+    self.rate = rate
+
+    # Ring buffer of frames (iteration, X, Y, A)
+    self.frames = deque(maxlen=size)
+
+    # Calls to run between two steps
+    self.calls = deque()
+
+    # Thread control
+    self.running = threading.Event()
+    self.stopped = False
+
+    # Exception raised by a step, if any
+    self.error = None
+    self.thread = threading.Thread(target=self.loop, daemon=True)
+
+  def start(self):
+    self.running.set()
+    self.thread.start()
+
+  def pause(self):
+    self.running.clear()
+
+  def resume(self):
+    self.running.set()
+
+  def stop(self):
+    self.stopped = True
+    self.running.set()
+
+  def call(self, f):
+    '''
+    Run f() in the worker thread, between two steps (e.g. to modify the
+    positions of the agents)
+    '''
+
+    self.calls.append(f)
+
+  def latest(self):
+    '''
+    Newest frame, or None if no frame has been computed yet
+    '''
+
+    return self.frames[-1] if self.frames else None
+
+  def loop(self):
+
+    tref = time.perf_counter()
+    k = 0
+    rate = self.rate
+
+    while True:
+
+      self.running.wait()
+      if self.stopped:
+        break
+
+      # Pending calls
+      while self.calls:
+        self.calls.popleft()()
+
+      # Step
+      try:
+        self.engine.step()
+      except Exception as e:
+        self.error = e
+        break
+
+      A = self.engine.agents
+      self.frames.append((self.engine.iteration, A.x.copy(), A.y.copy(), A.a.copy()))
+
+      # Simulation rate
+      if self.rate is None:
+        continue
+
+      # Rate changed
+      if self.rate!=rate:
+        rate = self.rate
+        tref = time.perf_counter()
+        k = 0
+
+      k += 1
+      dt = tref + k/self.rate - time.perf_counter()
+      if dt>0:
+        time.sleep(dt)
+      else:
+        tref = time.perf_counter()
+        k = 0
@@ -0,0 +1,311 @@
+'''
+Compiled model kernels (optional, requires numba)
+
+Each kernel fuses the neighbor search, the reduction over the neighbors and
+the move in a single compiled loop over the agents, run in parallel. The
+kernels have the same interface and give the same results as the NumPy
+kernels (see Kernels), up to rounding; check() compares the two backends.
+
+Without numba, the kernels still run as plain (slow) Python, and the
+engine falls back to the NumPy kernels.
+'''
+
+from math import pi, sin, cos, atan2, tanh
+
+import numpy as np
+
+# Optional JIT compiler
+try:
+  import numba
+  from numba import njit, prange
+except ImportError:
+  numba = None
+  prange = range
+  def njit(*args, **kwargs):
+    return lambda f: f
+
+# Modes with a compiled kernel
+modes = ('Vicsek', 'Aoki-Couzin', 'Perceptron')
+
+# === Cell list ============================================================
+
+@njit(cache=True)
+def _cells(X, Y, nc, cx, cy, order, start, count):
+  '''
+  Cell list of the points on a periodic nc x nc grid
+
+  Sets the cell coordinates of each point, the points sorted by cell and
+  the start and count of each cell in the sorted points.
+  '''
+
+  count[:] = 0
+
+  for i in range(X.size):
+    cx[i] = int(X[i]*nc) % nc
+    cy[i] = int(Y[i]*nc) % nc
+    count[cx[i]*nc + cy[i]] += 1
+
+  start[0] = 0
+  for c in range(1, nc*nc):
+    start[c] = start[c-1] + count[c-1]
+
+  # Counting sort (the counts are rebuilt while filling)
+  count[:] = 0
+  for i in range(X.size):
+    c = cx[i]*nc + cy[i]
+    order[start[c] + count[c]] = i
+    count[c] += 1
+
+def cells(agents, F, r):
+  '''
+  Cell list of F for a distance r, in scratch arrays of the agents. The
+  grid has cells of size at least r, or a single cell if there are less
+  than 3 cells per dimension.
+
+  Returns the number of cells per dimension nc, the half-width w of the
+  block of cells to search around each point (1 or 0) and the cell list.
+  '''
+
+  N = F.X.size
+  nc = min(int(1/r), max(1, int(2*np.sqrt(N)))) if r>0 else 1
+  if nc<3:
+    nc = 1
+
+  C = (agents.buffer('cx', N, np.int64), agents.buffer('cy', N, np.int64), agents.buffer('order', N, np.int64),
+    agents.buffer('start', nc*nc, np.int64), agents.buffer('count', nc*nc, np.int64))
+  _cells(F.X, F.Y, nc, *C)
+
+  return (nc, 1 if nc>1 else 0) + C
+
+# === Vicsek ===============================================================
+
+@njit(parallel=True, cache=True)
+def _vicsek(X, Y, A, r, sigma, v, noise, nc, w, cx, cy, order, start, count, Xo, Yo, Ao):
+
+  for i in prange(X.size):
+
+    # Mean heading (itself included)
+    sx = cos(A[i])
+    sy = sin(A[i])
+
+    for dx in range(-w, w+1):
+      for dy in range(-w, w+1):
+
+        c = ((cx[i]+dx) % nc)*nc + (cy[i]+dy) % nc
+
+        for k in range(start[c], start[c]+count[c]):
+
+          j = order[k]
+          x = (X[j] - X[i] + 0.5) % 1 - 0.5
+          y = (Y[j] - Y[i] + 0.5) % 1 - 0.5
+          d2 = x*x + y*y
+
+          if d2>0 and d2<=r[i]*r[i]:
+            sx += cos(A[j])
+            sy += sin(A[j])
+
+    # Angular noise and move
+    a = atan2(sy, sx) + sigma[i]*noise[i]
+    Ao[i] = a
+    Xo[i] = (X[i] + v[i]*cos(a)) % 1
+    Yo[i] = (Y[i] + v[i]*sin(a)) % 1
+
+def vicsek(agents, F):
+  '''
+  Vicsek update (see Kernels.vicsek)
+  '''
+
+  noise = agents.noise()
+  _vicsek(F.X, F.Y, F.A, agents.r, agents.sigma_out, agents.v, noise,
+    *cells(agents, F, agents.engine.params.max('r')), agents.x, agents.y, agents.a)
+
+# === Aoki-Couzin ==========================================================
+
+@njit(parallel=True, cache=True)
+def _aoki_couzin(X, Y, A, Rrep, Ral, Ratt, alpha, damax, sigma, v, noise, nc, w, cx, cy, order, start, count, Xo, Yo, Ao):
+
+  for i in prange(X.size):
+
+    nrep = 0
+    nal = 0
+    natt = 0
+    xrep = 0.
+    yrep = 0.
+    xal = 0.
+    yal = 0.
+    xatt = 0.
+    yatt = 0.
+
+    for dx in range(-w, w+1):
+      for dy in range(-w, w+1):
+
+        c = ((cx[i]+dx) % nc)*nc + (cy[i]+dy) % nc
+
+        for k in range(start[c], start[c]+count[c]):
+
+          j = order[k]
+          x = (X[j] - X[i] + 0.5) % 1 - 0.5
+          y = (Y[j] - Y[i] + 0.5) % 1 - 0.5
+          d2 = x*x + y*y
+
+          if d2==0 or d2>Ratt[i]*Ratt[i]:
+            continue
+
+          # Blind sector
+          theta = (atan2(y, x) - A[i]) % (2*pi)
+          if theta>=pi-alpha[i] and theta<=pi+alpha[i]:
+            continue
+
+          # Zones
+          rho = np.sqrt(d2)
+          if rho<=Rrep[i]:
+            nrep += 1
+            xrep += cos(theta)
+            yrep += sin(theta)
+          elif rho<=Ral[i]:
+            nal += 1
+            xal += cos(A[j])
+            yal += sin(A[j])
+          else:
+            natt += 1
+            xatt += cos(theta)
+            yatt += sin(theta)
+
+    # Reorientation
+    if nrep:
+      da = atan2(-yrep, -xrep)
+    else:
+      dal = (atan2(yal, xal) - A[i] + pi) % (2*pi) - pi
+      datt = atan2(yatt, xatt)
+      if nal and natt:
+        da = atan2(sin(dal) + sin(datt), cos(dal) + cos(datt))
+      elif nal:
+        da = dal
+      elif natt:
+        da = datt
+      else:
+        da = 0.
+
+    da = min(max(da, -damax[i]), damax[i])
+
+    # Angular noise and move
+    a = A[i] + da + sigma[i]*noise[i]
+    Ao[i] = a
+    Xo[i] = (X[i] + v[i]*cos(a)) % 1
+    Yo[i] = (Y[i] + v[i]*sin(a)) % 1
+
+def aoki_couzin(agents, F):
+  '''
+  Aoki-Couzin update (see Kernels.aoki_couzin)
+  '''
+
+  # Perception is limited to half the domain
+  R = min(agents.engine.params.max('Ratt'), 0.5)
+  Ratt = agents.Ratt if R==agents.engine.params.max('Ratt') else np.minimum(agents.Ratt, R)
+
+  noise = agents.noise()
+  _aoki_couzin(F.X, F.Y, F.A, agents.Rrep, agents.Ral, Ratt, agents.alpha, agents.damax,
+    agents.sigma_out, agents.v, noise, *cells(agents, F, R), agents.x, agents.y, agents.a)
+
+# === Perceptron ===========================================================
+
+@njit(parallel=True, cache=True)
+def _perceptron(X, Y, A, W, delta, damax, sigma, v, noise, nc, w, cx, cy, order, start, count, Xo, Yo, Ao):
+
+  ns = W.shape[1]
+
+  for i in prange(X.size):
+
+    # Sector histogram
+    V = np.zeros(ns)
+
+    for dx in range(-w, w+1):
+      for dy in range(-w, w+1):
+
+        c = ((cx[i]+dx) % nc)*nc + (cy[i]+dy) % nc
+
+        for k in range(start[c], start[c]+count[c]):
+
+          j = order[k]
+          x = (X[j] - X[i] + 0.5) % 1 - 0.5
+          y = (Y[j] - Y[i] + 0.5) % 1 - 0.5
+          d2 = x*x + y*y
+
+          if d2==0 or d2>0.25:
+            continue
+
+          theta = ((atan2(y, x) - A[i]) % (2*pi) - delta[i]) % (2*pi)
+          s = min(int(theta*ns/2/pi), ns-1)
+          V[s] += 1/np.sqrt(d2)
+
+    # Weighted sum of the normalized inputs
+    S = V.sum()
+    u = 0.
+    if S>0:
+      for s in range(ns):
+        u += W[i,s]*V[s]/S
+
+    # Angular noise and move
+    a = A[i] + tanh(u)*damax[i] + sigma[i]*noise[i]
+    Ao[i] = a
+    Xo[i] = (X[i] + v[i]*cos(a)) % 1
+    Yo[i] = (Y[i] + v[i]*sin(a)) % 1
+
+def perceptron(agents, F):
+  '''
+  Perceptron update (see Kernels.perceptron)
+  '''
+
+  noise = agents.noise()
+  _perceptron(F.X, F.Y, F.A, agents.W, agents.delta, agents.damax, agents.sigma_out, agents.v, noise,
+    *cells(agents, F, 0.5), agents.x, agents.y, agents.a)
+
+# === Correctness ==========================================================
+
+def deviation(mode, N=500, steps=5, seed=0, dtype=np.float64):
+  '''
+  Run a mode with the NumPy and numba backends, from the same states and
+  random streams, on a heterogeneous swarm.
+
+  Returns the largest deviation of the positions and orientations, which
+  should not exceed a few rounding errors (the compiled kernels sum the
+  neighbors in a different order).
+  '''
+
+  from Engine import Engine
+
+  E = {}
+  for backend in ('numpy', 'numba'):
+
+    E[backend] = Engine(steps=steps, seed=seed, dtype=dtype)
+    E[backend].mode = mode
+    E[backend].backend = backend
+    A = E[backend].agents
+    A.add(N, mode)
+
+    # Heterogeneous parameters
+    rng = np.random.default_rng(seed)
+    A.set('r', rng.uniform(0.02, 0.08, N))
+    A.set('Rrep', rng.uniform(0.005, 0.02, N))
+    A.set('Ral', rng.uniform(0.03, 0.06, N))
+    A.set('Ratt', rng.uniform(0.08, 0.15, N))
+    A.set('alpha', rng.uniform(0, np.pi/2, N))
+    A.set('delta', rng.uniform(0, 2*np.pi, N))
+    A.W = rng.standard_normal((N, A.ns))
+
+    E[backend].run()
+
+  P = [np.column_stack((E[b].agents.x, E[b].agents.y, E[b].agents.a)).astype(float) for b in E]
+  D = np.abs(P[0]-P[1])
+  D[:,:2] = np.minimum(D[:,:2], 1-D[:,:2])
+
+  return D.max()
+
+def check(N=500, steps=5, seed=0, dtype=np.float64):
+  '''
+  Compare the compiled and NumPy kernels of each mode (see deviation).
+
+  Returns the largest deviation for each mode.
+  '''
+
+  return {mode: deviation(mode, N, steps, seed, dtype) for mode in modes}
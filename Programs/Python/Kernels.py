@@ -0,0 +1,194 @@
+'''
+Batched model kernels
+
+Each kernel updates the orientations of all agents at once from the
+compiled field of orientated points F, then moves the whole swarm. The new
+state is written in the state arrays of the agents, which are distinct
+from the arrays of F (see Agents._swap).
+'''
+
+import numpy as np
+
+from Neighbors import pairlist, index, grid, dense, large
+
+# === Reductions ===========================================================
+
+def neighborhood(F, r):
+  '''
+  Pair list of F for a distance r: the one computed for the current step
+  if there is one, otherwise a new one.
+  '''
+
+  if F.pairs is not None and F.pairs.r>=r:
+    return F.pairs
+  else:
+    return pairlist(F, r, F.index if F.index is not None else index(F, r))
+
+def neighborhoods(F, r, size=2**19):
+  '''
+  Pair lists of F for a distance r, by blocks of agents.
+
+  Yields (i0, i1, P), where P is the pair list of the agents i0:i1, with
+  the agent indices I relative to i0. When the pair list of the whole swarm
+  would exceed the memory budget (see Neighbors.large), the pairs are
+  searched for blocks of agents, with about size candidate distances per
+  block (all the distances if r covers a large part of the domain, those
+  of the neighboring cells of a grid otherwise), so that the kernels
+  reduce the pairs block by block. Otherwise, there is a single block (see
+  neighborhood).
+  '''
+
+  N = F.X.size
+
+  if (F.pairs is not None and F.pairs.r>=r) or not large(N, r):
+    yield 0, N, neighborhood(F, r)
+    return
+
+  # Index and number of agents per block
+  if dense(r):
+    idx = None
+    B = max(1, size//N)
+  else:
+    idx = grid(F, r)
+    B = max(1, int(size/(N*min(9*idx.size**2, 1))))
+
+  for i0 in range(0, N, B):
+    i1 = min(i0+B, N)
+    yield i0, i1, pairlist(F, r, idx, block=(i0, i1))
+
+def groupsum(I, Z, N):
+  '''
+  Sum of the complex values Z grouped by agent index I
+  '''
+
+  return np.bincount(I, weights=np.real(Z), minlength=N) + 1j*np.bincount(I, weights=np.imag(Z), minlength=N)
+
+# === Vicsek ===============================================================
+
+def vicsek(agents, F):
+  '''
+  Vicsek update: every agent takes the mean heading of all the agents lying
+  within its radius r (itself included), then adds noise and moves.
+  '''
+
+  # Headings of the agents themselves
+  Z = np.exp(1j*F.A)
+
+  # Sum of the headings of the neighbors
+  for i0, i1, P in neighborhoods(F, agents.engine.params.max('r')):
+    K = P.rho<=agents.r[i0 + P.I]
+    Z[i0:i1] += groupsum(P.I[K], np.exp(1j*F.A[P.J[K]]), i1-i0)
+
+  # Mean headings
+  np.arctan2(Z.imag, Z.real, out=agents.a)
+
+  # Add angular noise and move
+  agents.move(F)
+
+# === Aoki-Couzin ==========================================================
+
+def aoki_couzin(agents, F):
+  '''
+  Aoki-Couzin update, for all agents at once.
+
+  Neighbors outside the blind sector are classified in three concentric
+  zones (repulsion, alignment and attraction). Repulsion overrides the two
+  other zones, while alignment and attraction are combined. The resulting
+  reorientation is clamped to damax.
+  '''
+
+  N = agents.N
+
+  Nrep = np.zeros(N, dtype=int)
+  Nal = np.zeros(N, dtype=int)
+  Natt = np.zeros(N, dtype=int)
+  Zrep = np.zeros(N, dtype=complex)
+  Zal = np.zeros(N, dtype=complex)
+  Zatt = np.zeros(N, dtype=complex)
+
+  # --- Perception
+
+  for i0, i1, P in neighborhoods(F, min(agents.engine.params.max('Ratt'), 0.5)):
+
+    n = i1 - i0
+
+    # --- Blind sector
+
+    alpha = agents.alpha[i0 + P.I]
+    K = (P.theta<np.pi-alpha) | (P.theta>np.pi+alpha)
+    I = P.I[K]
+    rho = P.rho[K]
+    theta = P.theta[K]
+    beta = F.A[P.J[K]]
+
+    # --- Zones
+
+    Rrep = agents.Rrep[i0 + I]
+    Ral = agents.Ral[i0 + I]
+    Irep = rho<=Rrep
+    Ial = (rho>Rrep) & (rho<=Ral)
+    Iatt = (rho>Ral) & (rho<=agents.Ratt[i0 + I])
+
+    Nrep[i0:i1] = np.bincount(I[Irep], minlength=n)
+    Nal[i0:i1] = np.bincount(I[Ial], minlength=n)
+    Natt[i0:i1] = np.bincount(I[Iatt], minlength=n)
+
+    Zrep[i0:i1] = groupsum(I[Irep], np.exp(1j*theta[Irep]), n)
+    Zal[i0:i1] = groupsum(I[Ial], np.exp(1j*beta[Ial]), n)
+    Zatt[i0:i1] = groupsum(I[Iatt], np.exp(1j*theta[Iatt]), n)
+
+  # --- Reorientations
+
+  dal = np.mod(np.angle(Zal) - F.A + np.pi, 2*np.pi) - np.pi
+  datt = np.angle(Zatt)
+
+  da = np.zeros(N)
+  da = np.where(Natt>0, datt, da)
+  da = np.where(Nal>0, dal, da)
+  da = np.where((Nal>0) & (Natt>0), np.angle(np.exp(1j*dal) + np.exp(1j*datt)), da)
+  da = np.where(Nrep>0, np.angle(-Zrep), da)
+
+  # Update angle
+  np.add(F.A, np.clip(da, -agents.damax, agents.damax), out=agents.a)
+
+  # Add angular noise and move
+  agents.move(F)
+
+# === Perceptron ===========================================================
+
+def perceptron(agents, F):
+  '''
+  Perceptron update, for all agents at once.
+
+  The perception field of each agent is divided into ns angular sectors,
+  shifted by delta. The inputs are the normalized sums of inverse distances
+  of the neighbors in each sector, and the reorientation is the weighted
+  sum of the inputs (weights W, shape (N,ns)) passed through a tanh and
+  scaled by damax.
+  '''
+
+  N = agents.N
+  ns = agents.ns
+
+  V = np.zeros((N, ns))
+
+  # --- Perception
+
+  for i0, i1, P in neighborhoods(F, 0.5):
+
+    # Polar coordinates in the agents' frames, shifted by delta
+    theta = np.mod(P.theta - agents.delta[i0 + P.I], 2*np.pi)
+
+    # Sector histograms
+    k = np.minimum((theta*ns/2/np.pi).astype(int), ns-1)
+    V[i0:i1] = np.bincount(P.I*ns + k, weights=1/P.rho, minlength=(i1-i0)*ns).reshape((i1-i0, ns))
+
+  # Renormalization
+  S = V.sum(axis=1, keepdims=True)
+  V = np.divide(V, S, out=np.zeros_like(V), where=S>0)
+
+  # Update angle
+  np.add(F.A, np.tanh(np.sum(agents.W*V, axis=1))*agents.damax, out=agents.a)
+
+  # Add angular noise and move
+  agents.move(F)
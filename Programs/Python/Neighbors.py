@@ -0,0 +1,517 @@
+'''
+Neighbor search on the periodic unit square
+
+The neighbor indices are built once per step from the compiled field of
+orientated points, and then queried by the model kernels and the agents.
+'''
+
+from types import SimpleNamespace
+
+import numpy as np
+
+# Optional KD-tree backend
+try:
+  from scipy.spatial import cKDTree
+except ImportError:
+  cKDTree = None
+
+# === Brute force ==========================================================
+
+def brute(F, r):
+  '''
+  All pairs (i,j) of distinct agents such that j lies within a distance r
+  of i (with boundary conditions), by direct computation of all distances.
+
+  Returns the indices I and J and the relative positions (X,Y) of j with
+  respect to i, in the world frame.
+  '''
+
+  # Relative positions (with boundary conditions)
+  X = (F.X[None,:] - F.X[:,None] + 1/2) % 1 - 1/2
+  Y = (F.Y[None,:] - F.Y[:,None] + 1/2) % 1 - 1/2
+
+  # Pairs
+  D2 = X**2 + Y**2
+  I, J = np.nonzero((D2>0) & (D2<=r**2))
+
+  return I, J, X[I,J], Y[I,J]
+
+def rows(F, r, i0, i1):
+  '''
+  All pairs (i,j) of distinct agents within a distance r for the agents i
+  in i0:i1 (see brute), with i relative to i0.
+  '''
+
+  # Relative positions (with boundary conditions, rounding is much faster
+  # than the modulo on these dense blocks)
+  X = F.X[None,:] - F.X[i0:i1,None]
+  X -= np.rint(X)
+  Y = F.Y[None,:] - F.Y[i0:i1,None]
+  Y -= np.rint(Y)
+
+  # Pairs
+  D2 = X*X
+  D2 += Y*Y
+  I, J = np.nonzero((D2>0) & (D2<=r**2))
+
+  return I, J, X[I,J], Y[I,J]
+
+def dense(r):
+  '''
+  Whether a radius covers a large part of the domain, so that nearly all
+  pairs of agents match and an index is of no use.
+  '''
+
+  return np.pi*r**2>0.15
+
+# Largest number of pairs in a pair list of the whole swarm (see pairlist,
+# about 60 bytes per pair), above which the pairs are taken by blocks of
+# agents (see large)
+budget = 2**20
+
+def expected(N, r):
+  '''
+  Expected number of pairs within a distance r for N agents uniformly
+  distributed on the unit square (clustered swarms have more)
+  '''
+
+  return N*(N-1)*min(np.pi*r**2, 1)
+
+def large(N, r):
+  '''
+  Whether the pair list of a swarm of N agents for a distance r would
+  exceed the memory budget
+  '''
+
+  return expected(N, r)>budget
+
+def index(F, r, method='auto'):
+  '''
+  Neighbor index of F for queries up to a distance r.
+
+  method is one of:
+  - 'brute': no index, all distances are computed (returns None)
+  - 'grid': uniform grid (cell list)
+  - 'tree': periodic KD-tree (requires scipy, falls back to 'grid' otherwise)
+  - 'auto': brute force for small swarms and for radii covering a large
+    part of the domain (where nearly all pairs match), the grid for small
+    radii and the tree for intermediate radii
+  '''
+
+  if method=='auto':
+
+    if F.X.size<256 or dense(r):
+      method = 'brute'
+    elif r<=0.1 or cKDTree is None:
+      method = 'grid'
+    else:
+      method = 'tree'
+
+  match method:
+    case 'brute': return None
+    case 'grid': return grid(F, r)
+    case 'tree': return tree(F) if cKDTree is not None else grid(F, r)
+    case _: raise ValueError("Unknown neighbor search method '{:s}'.".format(method))
+
+# === Uniform grid =========================================================
+
+class grid:
+  '''
+  Uniform grid (cell list) on the periodic unit square
+
+  The square is divided in nc x nc cells of size at least r, so that all the
+  neighbors of a point within a distance r lie in the 9 cells around it.
+
+  For an ensemble of R replicas (N/R agents each, stored one after the
+  other), each replica has its own set of cells, so that only the agents of
+  the same replica are neighbors.
+  '''
+
+  def __init__(self, F, r, R=1):
+
+    self.F = F
+    self.R = R
+    N = F.X.size//R
+
+    # Number of cells per dimension
+    ncmax = max(1, int(2*np.sqrt(N)))
+    self.nc = min(int(1/r), ncmax) if r>0 else ncmax
+    self.nc = max(self.nc, 1)
+    self.size = 1/self.nc
+
+    # Cell coordinates
+    self.cx = (F.X*self.nc).astype(int) % self.nc
+    self.cy = (F.Y*self.nc).astype(int) % self.nc
+    self.ck = np.arange(F.X.size)//N if R>1 else 0
+    cell = (self.ck*self.nc + self.cx)*self.nc + self.cy
+
+    # Points sorted by cell
+    self.order = np.argsort(cell, kind='stable')
+    self.count = np.bincount(cell, minlength=R*self.nc**2)
+    self.start = np.cumsum(self.count) - self.count
+
+    # Offsets of the neighboring cells (without duplicates for small grids)
+    self.offsets = sorted({(dx % self.nc, dy % self.nc) for dx in (-1,0,1) for dy in (-1,0,1)})
+
+  def candidates(self, cx, cy, ck=0):
+    '''
+    Candidate neighbors of query points lying in cells (cx,cy) of replicas
+    ck.
+
+    Returns the index Q of the query and the index J of the candidate for
+    each candidate pair.
+    '''
+
+    Q = []
+    J = []
+
+    for dx, dy in self.offsets:
+
+      # Neighboring cells
+      c = (ck*self.nc + (cx+dx) % self.nc)*self.nc + (cy+dy) % self.nc
+      n = self.count[c]
+      s = self.start[c]
+
+      # Expand the contents of the cells
+      q = np.repeat(np.arange(c.size), n)
+      k = np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n) + np.repeat(s, n)
+
+      Q.append(q)
+      J.append(self.order[k])
+
+    return np.concatenate(Q), np.concatenate(J)
+
+  def pairs(self, r, block=None):
+    '''
+    All pairs of distinct agents within a distance r (see brute), or only
+    the pairs of the agents i0:i1 if block=(i0,i1), with i relative to i0
+    (single replica only).
+    '''
+
+    # Radius larger than the cells
+    if r>self.size:
+      if block is not None:
+        return rows(self.F, r, *block)
+      return brute(self.F, r) if self.R==1 else replicas(self.F, self.R, r, 'brute').pairs(r)
+
+    if block is None:
+      i0 = 0
+      I, J = self.candidates(self.cx, self.cy, self.ck)
+    else:
+      i0, i1 = block
+      I, J = self.candidates(self.cx[i0:i1], self.cy[i0:i1])
+
+    # Relative positions (with boundary conditions)
+    X = (self.F.X[J] - self.F.X[i0 + I] + 1/2) % 1 - 1/2
+    Y = (self.F.Y[J] - self.F.Y[i0 + I] + 1/2) % 1 - 1/2
+
+    # Pairs
+    D2 = X**2 + Y**2
+    K = (D2>0) & (D2<=r**2)
+
+    return I[K], J[K], X[K], Y[K]
+
+  def near(self, x, y, r):
+    '''
+    Indices of the points within a distance r of (x,y), including the
+    points lying exactly at (x,y).
+    '''
+
+    # Radius larger than the cells
+    if r>self.size:
+      J = np.arange(self.F.X.size)
+
+    else:
+      cx = np.array([int(x*self.nc) % self.nc])
+      cy = np.array([int(y*self.nc) % self.nc])
+      _, J = self.candidates(cx, cy)
+
+    # Relative positions (with boundary conditions)
+    X = (self.F.X[J] - x + 1/2) % 1 - 1/2
+    Y = (self.F.Y[J] - y + 1/2) % 1 - 1/2
+
+    return np.sort(J[X**2 + Y**2<=r**2])
+
+# === KD-tree ==============================================================
+
+class tree:
+  '''
+  Periodic KD-tree on the unit square (scipy's cKDTree)
+
+  Unlike the grid, the tree does not depend on a query radius, so it copes
+  well with swarms mixing very small and very large radii.
+  '''
+
+  def __init__(self, F):
+
+    self.F = F
+
+    # Points in [0,1)
+    P = np.column_stack((F.X, F.Y)) % 1
+    P[P>=1] = 0
+
+    self.kdt = cKDTree(P, boxsize=1)
+
+  def pairs(self, r):
+    '''
+    All pairs of distinct agents within a distance r (see brute).
+    '''
+
+    P = self.kdt.query_pairs(r, output_type='ndarray')
+    I = np.concatenate((P[:,0], P[:,1]))
+    J = np.concatenate((P[:,1], P[:,0]))
+
+    # Relative positions (with boundary conditions)
+    X = (self.F.X[J] - self.F.X[I] + 1/2) % 1 - 1/2
+    Y = (self.F.Y[J] - self.F.Y[I] + 1/2) % 1 - 1/2
+
+    # Remove coincident points
+    K = X**2 + Y**2 > 0
+
+    return I[K], J[K], X[K], Y[K]
+
+  def near(self, x, y, r):
+    '''
+    Indices of the points within a distance r of (x,y), including the
+    points lying exactly at (x,y).
+    '''
+
+    return np.sort(np.array(self.kdt.query_ball_point([x % 1, y % 1], r), dtype=int))
+
+# === Verlet list ==========================================================
+
+class verlet:
+  '''
+  Verlet neighbor list with a skin margin
+
+  The list holds all pairs within a distance r+skin, and is only rebuilt
+  (with the given search method) when an agent has moved by more than
+  skin/2 since the last rebuild. In between, the distances are recomputed
+  for the listed pairs only. It is kept across steps by the engine and
+  updated with the field of each step.
+  '''
+
+  def __init__(self, skin, method='auto'):
+
+    self.skin = skin
+    self.method = method
+
+    # Field of the current step
+    self.F = None
+
+    # Candidate pairs and reference positions
+    self.I = None
+    self.J = None
+    self.X0 = None
+    self.Y0 = None
+    self.rc = None
+
+    # Number of rebuilds
+    self.rebuilds = 0
+
+  def update(self, F, r):
+    '''
+    Set the field of the current step, and rebuild the list if needed.
+    '''
+
+    self.F = F
+
+    # Check rebuild
+    if self.I is None or self.rc!=r+self.skin or self.X0.size!=F.X.size:
+      rebuild = True
+    else:
+      X = (F.X - self.X0 + 1/2) % 1 - 1/2
+      Y = (F.Y - self.Y0 + 1/2) % 1 - 1/2
+      rebuild = np.max(X**2 + Y**2, initial=0)>(self.skin/2)**2
+
+    # Rebuild
+    if rebuild:
+
+      self.rc = r + self.skin
+      idx = index(F, self.rc, self.method)
+      self.I, self.J, _, _ = brute(F, self.rc) if idx is None else idx.pairs(self.rc)
+      self.X0 = F.X.copy()
+      self.Y0 = F.Y.copy()
+      self.rebuilds += 1
+
+    return self
+
+  def pairs(self, r):
+    '''
+    All pairs of distinct agents within a distance r (see brute).
+    '''
+
+    # Radius larger than the list
+    if r>self.rc-self.skin:
+      return brute(self.F, r)
+
+    # Relative positions (with boundary conditions)
+    X = (self.F.X[self.J] - self.F.X[self.I] + 1/2) % 1 - 1/2
+    Y = (self.F.Y[self.J] - self.F.Y[self.I] + 1/2) % 1 - 1/2
+
+    # Pairs
+    D2 = X**2 + Y**2
+    K = (D2>0) & (D2<=r**2)
+
+    return self.I[K], self.J[K], X[K], Y[K]
+
+  def near(self, x, y, r):
+    '''
+    Indices of the points within a distance r of (x,y), including the
+    points lying exactly at (x,y).
+    '''
+
+    X = (self.F.X - x + 1/2) % 1 - 1/2
+    Y = (self.F.Y - y + 1/2) % 1 - 1/2
+
+    return np.flatnonzero(X**2 + Y**2<=r**2)
+
+# === Replicas =============================================================
+
+class replicas:
+  '''
+  Neighbor index of an ensemble of R independent replicas
+
+  The field holds the R replicas one after the other (N agents each), and
+  only the agents of the same replica are neighbors. The replicas are
+  searched all at once, either by brute force for blocks of replicas or
+  with a grid having a set of cells per replica. The tree method builds a
+  tree per replica.
+  '''
+
+  def __init__(self, F, R, r, method='auto'):
+
+    self.F = F
+    self.R = R
+    self.N = F.X.size//R
+
+    if method=='auto':
+      method = 'grid' if min(int(1/r), int(2*np.sqrt(self.N)))>3 else 'brute'
+
+    self.method = method
+
+    match method:
+
+      case 'brute':
+        self.index = None
+
+      case 'grid':
+        self.index = grid(F, r, R)
+
+      case 'tree':
+        if cKDTree is None:
+          self.method = 'grid'
+          self.index = grid(F, r, R)
+        else:
+          self.index = [tree(SimpleNamespace(X=F.X[k*self.N:(k+1)*self.N], Y=F.Y[k*self.N:(k+1)*self.N]))
+            for k in range(R)]
+
+      case _:
+        raise ValueError("Unknown neighbor search method '{:s}'.".format(method))
+
+  def pairs(self, r):
+    '''
+    All pairs of distinct agents of the same replica within a distance r
+    (see brute).
+    '''
+
+    if self.method=='grid':
+      return self.index.pairs(r)
+
+    N = self.N
+    I = []
+    J = []
+    DX = []
+    DY = []
+
+    if self.method=='tree':
+
+      for k, idx in enumerate(self.index):
+        i, j, x, y = idx.pairs(r)
+        I.append(k*N + i)
+        J.append(k*N + j)
+        DX.append(x)
+        DY.append(y)
+
+    else:
+
+      X = self.F.X.reshape((self.R, N))
+      Y = self.F.Y.reshape((self.R, N))
+
+      # Blocks of replicas (about 256k distances each)
+      B = max(1, 2**18//max(N*N, 1))
+
+      for k0 in range(0, self.R, B):
+
+        # Relative positions (with boundary conditions)
+        x = (X[k0:k0+B,None,:] - X[k0:k0+B,:,None] + 1/2) % 1 - 1/2
+        y = (Y[k0:k0+B,None,:] - Y[k0:k0+B,:,None] + 1/2) % 1 - 1/2
+
+        # Pairs
+        D2 = x**2 + y**2
+        k, i, j = np.nonzero((D2>0) & (D2<=r**2))
+
+        I.append((k0+k)*N + i)
+        J.append((k0+k)*N + j)
+        DX.append(x[k,i,j])
+        DY.append(y[k,i,j])
+
+    return np.concatenate(I), np.concatenate(J), np.concatenate(DX), np.concatenate(DY)
+
+# === Pair list ============================================================
+
+class pairlist:
+  '''
+  Sparse list of the neighbor pairs of the whole swarm
+
+  Pairs (i,j) of distinct agents within a distance r are stored in CSR
+  layout: the neighbors of agent i are J[ptr[i]:ptr[i+1]]. For each pair:
+  - X, Y: relative position of j with respect to i (world frame)
+  - rho: distance
+  - phi: polar angle of j around i in the world frame, in [-pi,pi]
+  - theta: polar angle of j around i in the frame of i, in [0,2pi)
+
+  It is computed once per step and shared by all the model kernels. It can
+  also be restricted to the pairs of a block of agents i0:i1 (block), with
+  the indices I relative to i0, by brute force or with a grid index.
+  '''
+
+  def __init__(self, F, r, index=None, block=None):
+
+    self.r = r
+    i0, i1 = (0, F.X.size) if block is None else block
+    self.N = i1 - i0
+
+    # Pairs (sorted by i, except for indices)
+    if index is not None:
+      I, J, X, Y = index.pairs(r) if block is None else index.pairs(r, block)
+      K = np.argsort(I, kind='stable')
+      I, J, X, Y = I[K], J[K], X[K], Y[K]
+    elif block is not None:
+      I, J, X, Y = rows(F, r, i0, i1)
+    else:
+      I, J, X, Y = brute(F, r)
+
+    # CSR layout
+    self.I = I
+    self.J = J
+    self.ptr = np.concatenate(([0], np.cumsum(np.bincount(self.I, minlength=self.N))))
+
+    # World frame
+    self.X = X
+    self.Y = Y
+    self.rho = np.sqrt(self.X**2 + self.Y**2)
+    self.phi = np.arctan2(self.Y, self.X)
+
+    # Agent frame
+    self.theta = np.mod(self.phi - F.A[i0 + self.I], 2*np.pi)
+
+  def __len__(self):
+    return self.I.size
+
+  def neighbors(self, i):
+    '''
+    Slice of the pairs of agent i
+    '''
+
+    return slice(self.ptr[i], self.ptr[i+1])
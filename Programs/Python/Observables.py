@@ -0,0 +1,256 @@
+'''
+Observables computed during the simulation
+
+The observables are computed at each step from the compiled field of
+orientated points and the neighbor pairs of the step, and accumulated in
+preallocated arrays.
+'''
+
+import numpy as np
+
+import Neighbors
+from Kernels import neighborhood
+
+# Optional connected components
+try:
+  from scipy.sparse import coo_matrix
+  from scipy.sparse.csgraph import connected_components
+except ImportError:
+  connected_components = None
+
+# === Order parameters =====================================================
+
+def polarization(F):
+  '''
+  Polarization: norm of the mean heading, in [0,1]
+  '''
+
+  return np.abs(np.mean(np.exp(1j*F.A)))
+
+def milling(F):
+  '''
+  Milling (rotation order parameter): norm of the mean normalized angular
+  momentum around the center of mass, in [0,1]. The center of mass is the
+  circular mean of the positions (boundary conditions).
+  '''
+
+  # Center of mass
+  cx = np.angle(np.mean(np.exp(2j*np.pi*F.X)))/2/np.pi
+  cy = np.angle(np.mean(np.exp(2j*np.pi*F.Y)))/2/np.pi
+
+  # Relative positions
+  X = (F.X - cx + 1/2) % 1 - 1/2
+  Y = (F.Y - cy + 1/2) % 1 - 1/2
+  R = np.sqrt(X**2 + Y**2)
+  R[R==0] = np.inf
+
+  return np.abs(np.mean((X*np.sin(F.A) - Y*np.cos(F.A))/R))
+
+# === Neighbors ============================================================
+
+def nearest(F, P=None, size=2**19):
+  '''
+  Distance to the nearest neighbor of each agent (boundary conditions), at
+  any distance.
+
+  With scipy, the distances are given by a periodic KD-tree. Otherwise, the
+  distances are taken from the pair list P, if any, and computed by brute
+  force (by blocks of about size distances) for the agents without
+  neighbor in P.
+  '''
+
+  N = F.X.size
+
+  if N<2:
+    return np.full(N, np.nan)
+
+  # Periodic KD-tree
+  if Neighbors.cKDTree is not None:
+    kdt = Neighbors.tree(F).kdt
+    return kdt.query(kdt.data, k=2)[0][:,1]
+
+  # Pair list
+  D = np.full(N, np.nan)
+  if P is not None:
+    K = P.ptr[:-1]<P.ptr[1:]
+    D[K] = np.minimum.reduceat(P.rho, P.ptr[:-1][K])
+
+  # Brute force for the others
+  I = np.flatnonzero(np.isnan(D))
+  B = max(1, size//N)
+
+  for k in range(0, I.size, B):
+
+    i = I[k:k+B]
+
+    # Relative positions (with boundary conditions)
+    X = (F.X[None,:] - F.X[i,None] + 1/2) % 1 - 1/2
+    Y = (F.Y[None,:] - F.Y[i,None] + 1/2) % 1 - 1/2
+
+    D2 = X**2 + Y**2
+    D2[np.arange(i.size), i] = np.inf
+    D[i] = np.sqrt(D2.min(axis=1))
+
+  return D
+
+def clusters(P, r):
+  '''
+  Number of clusters, i.e. of connected components of the graph linking
+  the agents closer than r
+  '''
+
+  K = P.rho<=r
+  I = P.I[K]
+  J = P.J[K]
+
+  if connected_components is not None:
+    return connected_components(coo_matrix((np.ones(I.size), (I, J)), shape=(P.N, P.N)), directed=False)[0]
+
+  # Label propagation
+  L = np.arange(P.N)
+  while True:
+    L0 = L.copy()
+    np.minimum.at(L, I, L[J])
+    L = L[L]
+    if np.array_equal(L, L0):
+      return np.unique(L).size
+
+# === Accumulator ==========================================================
+
+class observables:
+  '''
+  Observables of each step
+
+  names is a subset of 'polarization', 'milling', 'nnd' (mean nearest
+  neighbor distance and its distribution) and 'clusters'. The clusters use
+  the pairs within a distance r, which are taken from the step if
+  possible. The nearest neighbor distances are exact for all agents, r is
+  only the range of their distribution (larger distances are counted in
+  'nnd_over'). The results are stored in preallocated arrays, that are
+  extended if the number of steps is unknown.
+  '''
+
+  def __init__(self, names=('polarization', 'milling', 'nnd', 'clusters'), r=0.05, bins=50, steps=None):
+
+    self.names = list(names)
+    self.r = r
+
+    # Bins of the nearest neighbor distance distribution
+    self.edges = np.linspace(0, r, bins+1)
+
+    # Storage
+    self.n = 0
+    self.size = steps or 1024
+    self.data = {}
+    for name in self.names:
+      match name:
+        case 'nnd':
+          self.data['nnd'] = np.full(self.size, np.nan)
+          self.data['nnd_hist'] = np.zeros((self.size, bins), dtype=int)
+          self.data['nnd_over'] = np.zeros(self.size, dtype=int)
+        case 'clusters':
+          self.data['clusters'] = np.zeros(self.size, dtype=int)
+        case _:
+          self.data[name] = np.full(self.size, np.nan)
+
+  def __getitem__(self, name):
+    return self.data[name][:self.n]
+
+  def compute(self, F):
+    '''
+    Compute the observables of a step
+    '''
+
+    # Extend storage
+    if self.n==self.size:
+      for key, val in self.data.items():
+        self.data[key] = np.concatenate((val, np.zeros_like(val)))
+      self.size *= 2
+
+    k = self.n
+
+    if 'polarization' in self.names:
+      self.data['polarization'][k] = polarization(F)
+
+    if 'milling' in self.names:
+      self.data['milling'][k] = milling(F)
+
+    if 'nnd' in self.names:
+      P = F.pairs if F.pairs is not None and F.pairs.r>=self.r else None
+      D = nearest(F, P)
+      self.data['nnd'][k] = np.mean(D) if D.size else np.nan
+      self.data['nnd_hist'][k] = np.histogram(D, bins=self.edges)[0]
+      self.data['nnd_over'][k] = np.count_nonzero(D>self.r)
+
+    if 'clusters' in self.names:
+      self.data['clusters'][k] = clusters(neighborhood(F, self.r), self.r)
+
+    self.n += 1
+
+  def results(self):
+    '''
+    Dictionary of the observables of all the computed steps
+    '''
+
+    return {key: val[:self.n] for key, val in self.data.items()}
+
+  def save(self, filename):
+    '''
+    Save the observables (npz file)
+    '''
+
+    np.savez(filename, nnd_edges=self.edges, **self.results())
+
+# === Precision ============================================================
+
+def precision(mode='Vicsek', N=200, steps=500, R=16, seed=0):
+  '''
+  Accuracy of the single precision state (dtype=np.float32) with respect to
+  double precision, for a given mode.
+
+  Returns a dictionary with:
+  - 'step': the largest deviation of the positions and orientations after
+    one noiseless step from the same state, i.e. the rounding error of a
+    step: about 1e-7 relative in single precision, up to 1e-5 for the
+    Vicsek mean heading of neighbors nearly cancelling each other.
+  - 'polarization': the mean polarization over the second half of the runs
+    of R replicas, in double and single precision, and the standard error
+    of the double precision mean. Since the dynamics is chaotic and the two
+    precisions draw different noises, the trajectories diverge and only
+    such statistics can be compared; they should agree within a few
+    standard errors.
+  '''
+
+  from Engine import Ensemble
+
+  X = {}
+  M = {}
+
+  for dtype in (np.float64, np.float32):
+
+    # One noiseless step
+    E = Ensemble(R, seed=seed, dtype=dtype)
+    E.mode = mode
+    E.add(N, mode)
+    E.agents.set('sigma_out', 0)
+    E.run(1)
+    X[dtype] = np.column_stack((E.agents.x, E.agents.y, E.agents.a)).astype(np.float64)
+
+    # Long runs
+    E = Ensemble(R, seed=seed, dtype=dtype)
+    E.mode = mode
+    E.add(N, mode)
+    P = np.zeros(R)
+
+    for k in range(steps):
+      E.step()
+      if k>=steps//2:
+        P += np.abs(np.mean(np.exp(1j*E.state('a')), axis=1))
+
+    M[dtype] = P/(steps - steps//2)
+
+  D = np.abs(X[np.float64] - X[np.float32])
+  D[:,:2] = np.minimum(D[:,:2], 1-D[:,:2])
+
+  return {'step': D.max(),
+    'polarization': (np.mean(M[np.float64]), np.mean(M[np.float32]), np.std(M[np.float64])/np.sqrt(R))}
@@ -0,0 +1,170 @@
+'''
+Trajectory storage (HDF5)
+
+Trajectories are stored in a 'pos' dataset of shape (steps, N, 3), holding
+the positions x, y and orientation a of all agents at each step.
+'''
+
+import numpy as np
+
+# Optional HDF5 support
+try:
+  import h5py
+except ImportError:
+  h5py = None
+
+# === Writer ===============================================================
+
+class writer:
+  '''
+  Chunked HDF5 trajectory writer
+
+  The steps are buffered in memory and flushed to disk by blocks of K steps,
+  which is also the chunk size of the compressed dataset. If the number of
+  steps is not known, the dataset is extended at each flush. Trajectories
+  can be stored in single precision (dtype=np.float32) to halve their size.
+  '''
+
+  def __init__(self, filename, N, steps=None, K=64, compression='gzip', dtype=np.float64, **attrs):
+
+    if h5py is None:
+      raise ImportError('h5py is required to save trajectories.')
+
+    self.filename = filename
+    self.N = N
+    self.K = K
+
+    # File and dataset
+    self.file = h5py.File(filename, 'w')
+    self.pos = self.file.create_dataset('pos', shape=(steps or 0, N, 3), maxshape=(None, N, 3),
+      dtype=dtype, chunks=(K, N, 3), compression=compression)
+
+    # Metadata
+    for key, val in attrs.items():
+      self.file.attrs[key] = val
+
+    # Buffer
+    self.buffer = np.empty((K, N, 3), dtype=dtype)
+    self.start = 0
+    self.k = 0
+
+  def write(self, step, X, Y, A):
+    '''
+    Write the positions and orientations at a given step. Steps have to be
+    written in order.
+    '''
+
+    if not self.file:
+      raise ValueError('Step {:d} is written after the file was closed.'.format(step))
+
+    if step!=self.start+self.k:
+      raise ValueError('Step {:d} is written out of order (expected {:d}).'.format(step, self.start+self.k))
+
+    self.buffer[self.k,:,0] = X
+    self.buffer[self.k,:,1] = Y
+    self.buffer[self.k,:,2] = A
+    self.k += 1
+
+    if self.k==self.K:
+      self.flush()
+
+  def flush(self):
+    '''
+    Write the buffered steps to disk
+    '''
+
+    if not self.k:
+      return
+
+    # Extend dataset
+    if self.pos.shape[0]<self.start+self.k:
+      self.pos.resize(self.start+self.k, axis=0)
+
+    self.pos[self.start:self.start+self.k] = self.buffer[:self.k]
+
+    self.start += self.k
+    self.k = 0
+
+  def close(self):
+    '''
+    Flush the remaining steps and close the file
+    '''
+
+    if not self.file:
+      return
+
+    self.flush()
+    self.file.attrs['steps'] = self.start
+    self.file.close()
+    self.file = None
+
+# === Reader ===============================================================
+
+class reader:
+  '''
+  Trajectory reader, with random access to the steps
+
+  Trajectories are memory-mapped when possible (.npy files, contiguous
+  uncompressed HDF5 datasets). Chunked HDF5 datasets are read lazily, by
+  blocks of one chunk that are cached for sequential playback.
+  '''
+
+  def __init__(self, filename):
+
+    self.filename = filename
+    self.file = None
+    self.attrs = {}
+
+    if filename.endswith('.npy'):
+
+      self.pos = np.load(filename, mmap_mode='r')
+      self.K = 1
+
+    else:
+
+      if h5py is None:
+        raise ImportError('h5py is required to read trajectories.')
+
+      self.file = h5py.File(filename, 'r')
+      self.attrs = dict(self.file.attrs)
+      D = self.file['pos']
+
+      if D.chunks is None and D.id.get_offset() is not None:
+        self.pos = np.memmap(filename, mode='r', dtype=D.dtype, shape=D.shape, offset=D.id.get_offset())
+        self.K = 1
+      else:
+        self.pos = D
+        self.K = D.chunks[0]
+
+    # Dimensions
+    self.steps = int(self.attrs.get('steps', self.pos.shape[0]))
+    self.N = self.pos.shape[1]
+
+    # Block cache
+    self.block = None
+    self.b0 = None
+
+  def __len__(self):
+    return self.steps
+
+  def frame(self, step):
+    '''
+    Positions and orientations of all agents at a given step, as an (N,3)
+    array.
+    '''
+
+    if isinstance(self.pos, np.ndarray):
+      return self.pos[step]
+
+    # Load block
+    b0 = step - step % self.K
+    if b0!=self.b0:
+      self.block = self.pos[b0:min(b0+self.K, self.steps)]
+      self.b0 = b0
+
+    return self.block[step-b0]
+
+  def close(self):
+
+    if self.file is not None:
+      self.file.close()
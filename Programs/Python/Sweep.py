@@ -0,0 +1,182 @@
+'''
+Parameter sweeps
+
+Runs many independent headless replicas of the engine over a grid of
+parameters and seeds, in a pool of processes, and collects the time
+averages of the observables in a single CSV file (one row per replica).
+
+Example:
+  S = sweep('Vicsek', {'sigma_out': [0.05, 0.1, 0.2], 'r': [0.02, 0.05]},
+    N=500, steps=1000, seeds=10, output='vicsek.csv')
+  S.run()
+'''
+
+import os
+import csv
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from Engine import Engine
+from Observables import observables
+
+# === Replicas =============================================================
+
+def replica(task):
+  '''
+  Run one replica and return its row of results.
+
+  The observables are averaged over the steps after the transient (given
+  as a fraction of the steps).
+  '''
+
+  E = Engine(steps=task['steps'], seed=task['seed'])
+  E.mode = task['mode']
+  E.agents.add(task['N'], task['mode'])
+
+  # Parameters
+  for key, val in task['params'].items():
+    if key=='ns':
+      E.agents.ns = int(val)
+    else:
+      E.agents.set(key, val)
+
+  # Run
+  E.observables = observables(task['observables'], r=task['r'], steps=task['steps'])
+  E.run()
+
+  # Time averages
+  k = int(task['transient']*task['steps'])
+  row = {'id': task['id'], **task['params'], 'seed': task['seed']}
+  for name in task['observables']:
+    row[name] = np.nanmean(E.observables[name][k:])
+
+  return row
+
+def replicas(tasks):
+  '''
+  Run a chunk of replicas
+  '''
+
+  return [replica(task) for task in tasks]
+
+# === Sweep ================================================================
+
+class sweep:
+  '''
+  Sweep over a grid of parameters
+
+  grid maps agent parameter names (e.g. 'sigma_out', 'r' or 'w1') to the
+  lists of values to explore; all combinations are run for each seed.
+  seeds is a list of seeds or a number of seeds.
+
+  Completed replicas are appended to the output file as soon as their
+  chunk is done, so that an interrupted sweep resumes where it stopped
+  when run again with the same settings. A failed chunk does not stop the
+  others: its replicas are left to be run again, and the errors are raised
+  at the end.
+  '''
+
+  def __init__(self, mode, grid, N=100, steps=1000, seeds=1,
+    observables=('polarization',), r=0.05, transient=0.5,
+    output='sweep.csv', workers=None, chunksize=None):
+
+    self.mode = mode
+    self.grid = dict(grid)
+    self.N = N
+    self.steps = steps
+    self.seeds = list(range(seeds)) if isinstance(seeds, int) else list(seeds)
+    self.observables = list(observables)
+    self.r = r
+    self.transient = transient
+    self.output = output
+    self.workers = workers or os.cpu_count()
+    self.chunksize = chunksize
+
+  def tasks(self):
+    '''
+    List of all the replicas of the sweep
+    '''
+
+    keys = list(self.grid)
+    T = []
+
+    for values in itertools.product(*self.grid.values()):
+      for seed in self.seeds:
+        T.append({'id': len(T), 'mode': self.mode, 'N': self.N, 'steps': self.steps,
+          'seed': seed, 'params': dict(zip(keys, values)),
+          'observables': self.observables, 'r': self.r, 'transient': self.transient})
+
+    return T
+
+  def done(self):
+    '''
+    Ids of the replicas already in the output file (rows with missing
+    values are ignored)
+    '''
+
+    if not os.path.exists(self.output):
+      return set()
+
+    with open(self.output, newline='') as f:
+      return {int(row['id']) for row in csv.DictReader(f)
+        if None not in row and None not in row.values() and '' not in row.values()}
+
+  def repair(self):
+    '''
+    Remove the partial last line left in the output file by an interrupted
+    write
+    '''
+
+    if not os.path.exists(self.output):
+      return
+
+    with open(self.output, 'rb+') as f:
+      data = f.read()
+      if data and not data.endswith(b'\n'):
+        f.truncate(data.rfind(b'\n') + 1)
+
+  def run(self):
+    '''
+    Run the remaining replicas
+    '''
+
+    self.repair()
+    done = self.done()
+    T = [task for task in self.tasks() if task['id'] not in done]
+
+    if not T:
+      return
+
+    # Chunks (a few per worker, for load balancing)
+    size = self.chunksize or max(1, len(T)//(4*self.workers))
+    chunks = [T[k:k+size] for k in range(0, len(T), size)]
+
+    fields = ['id', *self.grid, 'seed', *self.observables]
+
+    # Header (also for a file left empty by an interrupted run)
+    new = not os.path.exists(self.output) or os.path.getsize(self.output)==0
+
+    with open(self.output, 'a', newline='') as f, ProcessPoolExecutor(max_workers=self.workers) as pool:
+
+      writer = csv.DictWriter(f, fieldnames=fields)
+      if new:
+        writer.writeheader()
+
+      errors = []
+
+      for future in as_completed([pool.submit(replicas, chunk) for chunk in chunks]):
+
+        try:
+          rows = future.result()
+        except Exception as e:
+          errors.append(e)
+          continue
+
+        writer.writerows(rows)
+        f.flush()
+
+    # Failed chunks
+    if errors:
+      raise RuntimeError('{:d} of {:d} chunks of the sweep failed (the other replicas are saved).'.format(len(errors), len(chunks))) from errors[0]
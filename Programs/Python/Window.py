@@ -7,7 +7,7 @@ from Animation import Animation
 
 class Window(QWidget):
   
-  def __init__(self, N, darkstyle=True):
+  def __init__(self, N, darkstyle=True, data_in=None, seed=None):
    
     self.darkstyle = darkstyle
 
@@ -56,7 +56,7 @@ class Window(QWidget):
 
     # --- Animation --------------------------------------------------------
 
-    self.animation = Animation(self, N, darkstyle=self.darkstyle)
+    self.animation = Animation(self, N, darkstyle=self.darkstyle, data_in=data_in, seed=seed)
     self.animation.shuffle()
 
     # --- Layouts & Widgets ---------------------move windo
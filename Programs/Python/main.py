@@ -1,6 +1,11 @@
+import sys
+
 from Window import *
 
 # touch: python 3.10.6
 # poly: python 3.10.9
 
-Window(100, darkstyle=False)
+# Optional trajectory file to replay
+data_in = sys.argv[1] if len(sys.argv)>1 else None
+
+Window(100, darkstyle=False, data_in=data_in)
@@ -0,0 +1,64 @@
+'''
+Headless simulation runner (no display, no Qt)
+
+Example:
+  python run.py Vicsek -N 1000 --steps 500 --seed 1 -p r=0.1 -p sigma_out=0.2
+'''
+
+import argparse
+import numpy as np
+
+from Engine import Engine
+from Observables import observables
+
+# === Command line =========================================================
+
+parser = argparse.ArgumentParser(description='Run a COCOA simulation without display.')
+
+parser.add_argument('mode', choices=['Blind', 'Vicsek', 'Aoki-Couzin', 'Perceptron'], help='Agents type')
+parser.add_argument('-N', type=int, default=100, help='Number of agents')
+parser.add_argument('--steps', type=int, default=1000, help='Number of steps')
+parser.add_argument('--seed', type=int, default=None, help='Random seed')
+parser.add_argument('-p', '--param', action='append', default=[], metavar='KEY=VALUE',
+  help="Agent parameter, e.g. 'r=0.1' or 'w1=0.5' (can be repeated)")
+parser.add_argument('--ns', type=int, default=None, help='Number of perception sectors (Perceptron)')
+parser.add_argument('--neighbors', default='auto', choices=['auto', 'brute', 'grid', 'tree'], help='Neighbor search method')
+parser.add_argument('--skin', type=float, default=None, help='Verlet list skin')
+parser.add_argument('--float32', action='store_true', help='Single precision state and trajectory file')
+parser.add_argument('--backend', default='numpy', choices=['numpy', 'numba'], help='Model kernels (numba: compiled, if installed)')
+parser.add_argument('-o', '--out', default=None, help='Output trajectory file (HDF5)')
+parser.add_argument('--observables', default=None, metavar='NAMES',
+  help="Comma-separated observables to compute at each step: polarization, milling, nnd, clusters")
+parser.add_argument('--obs-out', default='observables.npz', help='Output file of the observables (npz)')
+parser.add_argument('--verbose', type=int, default=None, metavar='K', help='Print progress every K steps')
+
+args = parser.parse_args()
+
+# === Simulation ===========================================================
+
+E = Engine(steps=args.steps, data_out=args.out, neighbors=args.neighbors, skin=args.skin, seed=args.seed,
+  dtype=np.float32 if args.float32 else np.float64)
+E.mode = args.mode
+E.backend = args.backend
+E.verbose = args.verbose
+
+# Agents
+E.agents.add(args.N, args.mode)
+
+if args.ns is not None:
+  E.agents.ns = args.ns
+
+for p in args.param:
+  key, value = p.split('=')
+  E.agents.set(key.strip(), float(value))
+
+# Observables
+if args.observables is not None:
+  E.observables = observables(args.observables.split(','), steps=args.steps)
+
+# Run
+E.run()
+E.close()
+
+if E.observables is not None:
+  E.observables.save(args.obs_out)
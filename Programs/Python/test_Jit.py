@@ -0,0 +1,62 @@
+'''
+Agreement of the model kernels (run with pytest)
+
+Each mode is run with the NumPy and numba backends from the same seed and
+initial state, with heterogeneous parameters, in double and single
+precision. The final states have to agree up to rounding. The NumPy
+kernels are also checked against the per-agent reference (agent.update),
+so that an error shared by both backends does not go unnoticed.
+'''
+
+import numpy as np
+import pytest
+
+from Engine import Engine
+import Jit
+
+# Tolerances (a few rounding errors, amplified over the steps)
+tol = {np.float64: 1e-12, np.float32: 1e-4}
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('mode', Jit.modes)
+def test_backends(mode, dtype):
+
+  pytest.importorskip('numba')
+
+  assert Jit.deviation(mode, N=500, steps=5, seed=0, dtype=dtype)<=tol[dtype]
+
+@pytest.mark.parametrize('mode', Jit.modes)
+def test_reference(mode, N=300, seed=0):
+
+  E = Engine(seed=seed)
+  E.mode = mode
+  A = E.agents
+  A.add(N, mode)
+
+  # Heterogeneous parameters, without noise
+  rng = np.random.default_rng(seed)
+  A.set('sigma_out', 0)
+  A.set('r', rng.uniform(0.02, 0.08, N))
+  A.set('Rrep', rng.uniform(0.005, 0.02, N))
+  A.set('Ral', rng.uniform(0.03, 0.06, N))
+  A.set('Ratt', rng.uniform(0.08, 0.15, N))
+  A.set('alpha', rng.uniform(0, np.pi/2, N))
+  A.set('delta', rng.uniform(0, 2*np.pi, N))
+  A.W = rng.standard_normal((N, A.ns))
+
+  # Batched kernel
+  F = A.compile()
+  E.step()
+  P = np.column_stack((A.x, A.y, A.a))
+
+  # Per-agent reference, from the same state
+  A.restore(F)
+  for agent in A.list:
+    agent.update(0, F)
+  Q = np.column_stack((A.x, A.y, A.a))
+
+  D = np.abs(P-Q)
+  D[:,:2] = np.minimum(D[:,:2], 1-D[:,:2])
+  D[:,2] = np.abs(np.angle(np.exp(1j*(P[:,2]-Q[:,2]))))
+
+  assert D.max()<=tol[np.float64]